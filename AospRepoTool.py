@@ -26,46 +26,552 @@ otherwise to promote the sale, use or other dealings in this Software without pr
 
 import xmltodict
 import subprocess
-import pdb
 import os.path
+import fnmatch
 import git
+import hashlib
 import json
 import tarfile
 import logging
+import re
+import select
+import shlex
+import shutil
+import socket
+import sqlite3
 import stat
+import sys
+import tempfile
+import threading
+import time
 
 from argparse import ArgumentParser
-from os.path import join, exists, abspath, expanduser, isdir, isfile, islink
+from git.util import hex_to_bin
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from os.path import join, exists, abspath, expanduser, isdir, isfile, islink, realpath, getmtime, getsize
 from os import makedirs, walk
 
+# Number of incremental deepening attempts before falling back on a full unshallow
+DEEPEN_ROUNDS = 8
+
+# Approximate memory footprint in bytes of a commit id kept during divergence search
+SEEN_ENTRY_SIZE = 160
+
+# Patch compression commands: compression, decompression, file suffix
+COMPRESSORS = {'gzip': ('gzip -c', 'gzip -dc', '.gz'),
+               'xz': ('xz -T0 -c', 'xz -dc', '.xz'),
+               'zstd': ('zstd -q -c', 'zstd -q -dc', '.zst')}
+
+# Options which can be overloaded by each delivery of a batch
+BATCH_KEYS = ['since_tag', 'to_tag', 'product', 'product_tag', 'output_folder']
+
+# Minimum delay in seconds between two progress messages of a phase
+PROGRESS_INTERVAL = 5.0
+
+# Read size in bytes when computing delivery checksums
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+# Database of peeled refs shared by runs, in .repo folder
+REF_CACHE_NAME = 'aosp_repo_tool_refs.db'
+
+
+class AospRepoToolError(Exception):
+    """
+    Error stopping a delivery, code being the exit status of the command line tool
+    """
+    def __init__(self, message, code=1):
+        super().__init__(message)
+        self.code = code
+
+
+class ErrorCollector(logging.Handler):
+    """
+    Logging handler keeping error messages for structured results
+    """
+    def __init__(self, errors):
+        super().__init__(level=logging.ERROR)
+        self._errors = errors
+
+    def emit(self, record):
+        self._errors.append(record.getMessage())
+
+
+# Structured results of library use
+ProjectResult = namedtuple('ProjectResult', ['path', 'basename', 'revision', 'remote_url', 'commit_manifest',
+                                             'commit_co', 'commit_courant', 'need_patch'])
+PatchResult = namedtuple('PatchResult', ['path', 'file_name', 'need_patch'])
+ArchiveResult = namedtuple('ArchiveResult', ['path', 'archive'])
+DeliveryResult = namedtuple('DeliveryResult', ['output_folder', 'projects', 'patches', 'archives',
+                                               'removed_projects', 'tracked_projects', 'left_repos', 'errors'])
+
+
+class DeliveryReport:
+    """
+    Json delivery report written incrementally: entries are streamed to disk as soon as they are known and totals
+    are summarized when closing
+    """
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._lock = threading.Lock()
+        self._count = 0
+        self._totals = {}
+        self._start = time.time()
+        self._fd = open(file_name, 'w')
+        self._fd.write("{\n  \"entries\": [\n")
+
+    @property
+    def file_name(self):
+        return self._file_name
+
+    def add(self, entry):
+        """
+        Appends an entry to the report
+        :param entry: Dictionary with a 'kind' key ('project' or 'archive')
+        :return:
+        """
+        with self._lock:
+            if self._count:
+                self._fd.write(",\n")
+            self._fd.write("    " + json.dumps(entry))
+            self._fd.flush()
+            self._count += 1
+            totals = self._totals.setdefault(entry['kind'], {'count': 0})
+            totals['count'] += 1
+            for key, value in entry.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[key] = round(totals.get(key, 0) + value, 3)
+
+    def close(self):
+        """
+        Writes summary and closes the report
+        :return:
+        """
+        with self._lock:
+            summary = {'totals': self._totals, 'duration': round(time.time() - self._start, 3)}
+            self._fd.write("\n  ],\n  \"summary\": {}\n}}\n".format(json.dumps(summary)))
+            self._fd.close()
+
+
+class ProgressReporter:
+    """
+    Progress of a processing phase (done items, processed bytes, throughput and ETA) logged at most once per
+    interval, messages being only built when emitted so that hot loops can update it freely
+    """
+    def __init__(self, logger, phase, total=0, unit='projects', interval=PROGRESS_INTERVAL):
+        self.logger = logger
+        self._phase = phase
+        self._total = total
+        self._unit = unit
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._done = 0
+        self._bytes = 0
+        self._start = time.time()
+        self._last = self._start
+        self._emitted = False
+
+    @staticmethod
+    def humanSize(size):
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if size < 1024:
+                break
+            size /= 1024.0
+        else:
+            unit = 'TB'
+        return "{:.1f} {}".format(size, unit)
+
+    @staticmethod
+    def humanDuration(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+    def status(self, now):
+        """
+        Builds progress message
+        :param now: Current time
+        :return: Message string
+        """
+        elapsed = max(now - self._start, 1e-6)
+        rate = self._done / elapsed
+        message = "{}: {}/{} {} in {} ({:.1f} {}/s".format(self._phase, self._done, self._total or '?', self._unit,
+                                                          self.humanDuration(elapsed), rate, self._unit)
+        if self._bytes:
+            message += ", {}/s".format(self.humanSize(self._bytes / elapsed))
+        message += ")"
+        if self._total and rate and self._done < self._total:
+            message += " ETA {}".format(self.humanDuration((self._total - self._done) / rate))
+        return message
+
+    def update(self, items=1, size=0):
+        """
+        Records progress, logging it if interval is elapsed since last message
+        :param items: Number of items done
+        :param size: Number of bytes processed
+        :return:
+        """
+        with self._lock:
+            self._done += items
+            self._bytes += size
+            now = time.time()
+            if now - self._last < self._interval or not self.logger.isEnabledFor(logging.INFO):
+                return
+            self._last = now
+            self._emitted = True
+            message = self.status(now)
+        self.logger.info(message)
+
+    def finish(self):
+        """
+        Logs phase completion, at debug level for phases too short to have reported progress
+        :return:
+        """
+        with self._lock:
+            now = time.time()
+            if self._emitted or now - self._start >= self._interval:
+                level = logging.INFO
+            else:
+                level = logging.DEBUG
+            if not self.logger.isEnabledFor(level):
+                return
+            message = self.status(now)
+        self.logger.log(level, message)
+
+
+class GitMetadata:
+    """
+    In-process reader of git metadata (git folder or gitlink, HEAD, loose and packed refs, configuration) sparing
+    git process launches for cheap lookups, objects and history being left to git
+    """
+    def __init__(self, path):
+        """
+        :param path: Working tree or git folder
+        :raise git.exc.NoSuchPathError: if path does not exist
+        :raise git.exc.InvalidGitRepositoryError: if path holds no git metadata
+        """
+        if not exists(path):
+            raise git.exc.NoSuchPathError(path)
+        self._path = path
+        self._cache = {}
+
+        git_dir = join(path, '.git')
+        if isfile(git_dir):
+            # Gitlink of submodules and worktrees
+            with open(git_dir, 'r') as fd:
+                content = fd.read().strip()
+            if not content.startswith('gitdir:'):
+                raise git.exc.InvalidGitRepositoryError(path)
+            git_dir = join(path, content[len('gitdir:'):].strip())
+        elif not isdir(git_dir):
+            if not isfile(join(path, 'HEAD')):
+                raise git.exc.InvalidGitRepositoryError(path)
+            git_dir = path
+        self._git_dir = os.path.normpath(git_dir)
+
+        self._common_dir = self._git_dir
+        if isfile(join(self._git_dir, 'commondir')):
+            with open(join(self._git_dir, 'commondir'), 'r') as fd:
+                self._common_dir = os.path.normpath(join(self._git_dir, fd.read().strip()))
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def git_dir(self):
+        return self._git_dir
+
+    @property
+    def common_dir(self):
+        return self._common_dir
+
+    def cached(self, file_name, parser):
+        """
+        Parses a metadata file again only when it changed
+        :param file_name: File to read
+        :param parser: Callable building a value from file lines
+        :return: Parsed value, parser result of no lines if file does not exist
+        """
+        try:
+            st = os.stat(file_name)
+            key = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            key = None
+        if file_name not in self._cache or self._cache[file_name][0] != key:
+            lines = []
+            if key:
+                with open(file_name, 'r', errors='replace') as fd:
+                    lines = fd.read().splitlines()
+            self._cache[file_name] = (key, parser(lines))
+        return self._cache[file_name][1]
+
+    @staticmethod
+    def parsePackedRefs(lines):
+        refs = {}
+        fully_peeled = bool(lines) and lines[0].startswith('#') and 'fully-peeled' in lines[0]
+        name = None
+        for line in lines:
+            if line.startswith('^') and name:
+                refs[name] = (refs[name][0], line[1:].strip())
+            elif line and not line.startswith('#'):
+                sha, name = line.split(' ', 1)
+                refs[name] = (sha, sha if fully_peeled else None)
+        return refs
+
+    @staticmethod
+    def parseConfig(lines):
+        config = OrderedDict()
+        values = {}
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('['):
+                header = line[1:line.index(']')].strip() if ']' in line else line[1:]
+                section, _, subsection = header.partition(' ')
+                values = config.setdefault((section.lower(), subsection.strip().strip('"')), {})
+            elif '=' in line:
+                key, value = line.split('=', 1)
+                values.setdefault(key.strip().lower(), []).append(value.strip().strip('"'))
+            else:
+                values.setdefault(line.lower(), []).append('true')
+        return config
+
+    def config(self):
+        """
+        :return: Ordered dictionary of {key: [values]} by (section, subsection)
+        """
+        return self.cached(join(self._common_dir, 'config'), self.parseConfig)
+
+    def remotes(self):
+        """
+        :return: Ordered dictionary of remote urls by remote name
+        """
+        return OrderedDict([(subsection, values.get('url', []))
+                            for (section, subsection), values in self.config().items() if section == 'remote'])
+
+    @property
+    def bare(self):
+        return self.config().get(('core', ''), {}).get('bare', ['false'])[-1].lower() == 'true'
+
+    def isShallow(self):
+        shallow = join(self._common_dir, 'shallow')
+        return exists(shallow) and getsize(shallow) > 0
+
+    def readRef(self, name, depth=0):
+        """
+        Reads a ref, following symbolic refs
+        :param name: Full ref name (HEAD, refs/...)
+        :param depth: Symbolic refs already followed
+        :return: Tuple of final ref name, object id and peeled object id (None if unknown), None if ref does not exist
+        """
+        folder = self._common_dir
+        if not name.startswith('refs/') or name.startswith('refs/worktree/') or name.startswith('refs/bisect/'):
+            folder = self._git_dir
+        try:
+            with open(join(folder, name), 'r') as fd:
+                content = fd.read().strip()
+        except OSError:
+            content = None
+
+        if content is None:
+            entry = self.cached(join(self._common_dir, 'packed-refs'), self.parsePackedRefs).get(name)
+            if entry:
+                return name, entry[0], entry[1]
+            return None
+        if content.startswith('ref:'):
+            if depth >= 5:
+                return None
+            return self.readRef(content[len('ref:'):].strip(), depth + 1)
+
+        # Branches and HEAD only point to commits, loose tags need git to be peeled
+        peeled = None
+        if not name.startswith('refs/tags/'):
+            peeled = content
+        return name, content, peeled
+
+    def resolveRef(self, name):
+        """
+        Resolves a short or full ref name the way git does (name, refs/, tags, branches, remote branches)
+        :param name: Ref name
+        :return: Tuple of final ref name, object id and peeled object id (None if unknown), None if no ref matches
+        """
+        for candidate in [name, 'refs/' + name, 'refs/tags/' + name, 'refs/heads/' + name, 'refs/remotes/' + name,
+                          'refs/remotes/' + name + '/HEAD']:
+            ref = self.readRef(candidate)
+            if ref:
+                return ref
+        return None
+
+
+class RefCache:
+    """
+    Cache of commits pointed by refs which git metadata does not peel (annotated loose tags, packed refs without
+    peeling), shared by projects of a run through SQLite, and by runs when stored in a file. An object always peels
+    to the same commit: entries are keyed by object store and ref object id, and shared by every checkout using the
+    object store, a moved ref missing the cache
+    """
+    def __init__(self, file_name, logger):
+        """
+        :param file_name: SQLite database, None for a cache limited to this run
+        :param logger: Logger
+        """
+        self._file_name = file_name or ':memory:'
+        self.logger = logger
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._fetches = {}
+        self._enabled = True
+        if not file_name:
+            # Every connection to ':memory:' is a new database, a single one is shared under lock
+            self._local = None
+            self._shared = self.connect()
+
+    def connect(self):
+        connection = sqlite3.connect(self._file_name, timeout=30, check_same_thread=False)
+        connection.execute("CREATE TABLE IF NOT EXISTS peeled (store TEXT, object TEXT, commit_id TEXT, "
+                           "PRIMARY KEY (store, object))")
+        connection.commit()
+        return connection
+
+    def connection(self):
+        """
+        :return: SQLite connection of calling thread
+        """
+        if self._local is None:
+            return self._shared
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = self.connect()
+        return self._local.connection
+
+    @contextmanager
+    def access(self):
+        if self._local is None:
+            with self._lock:
+                yield self.connection()
+        else:
+            yield self.connection()
+
+    def get(self, store, object_id):
+        """
+        :param store: Objects folder holding the object
+        :param object_id: Object id read in a ref
+        :return: Commit id or None if not cached
+        """
+        if not self._enabled:
+            return None
+        try:
+            with self.access() as connection:
+                row = connection.execute("SELECT commit_id FROM peeled WHERE store=? AND object=?",
+                                         (store, object_id)).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            self.disable(e)
+            return None
+
+    def put(self, store, object_id, commit_id):
+        """
+        Records the commit pointed by an object read in a ref
+        :param store: Objects folder holding the object
+        :param object_id: Object id read in a ref
+        :param commit_id: Peeled commit id
+        :return:
+        """
+        if not self._enabled:
+            return
+        try:
+            with self.access() as connection:
+                connection.execute("INSERT OR REPLACE INTO peeled VALUES (?, ?, ?)", (store, object_id, commit_id))
+                connection.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+
+    def disable(self, error):
+        self.logger.warning("! Ref cache {} disabled: {}".format(self._file_name, error))
+        self._enabled = False
+
+    def fetchOnce(self, store, fetch):
+        """
+        Runs a fetch once per git folder, projects sharing the folder waiting for the first one to finish
+        :param store: Git folder receiving fetched refs
+        :param fetch: Callable doing the fetch
+        :return: True if fetch was run by this call
+        """
+        with self._lock:
+            lock, done = self._fetches.setdefault(store, (threading.Lock(), []))
+        with lock:
+            if done:
+                return False
+            fetch()
+            done.append(True)
+            return True
+
+    def forgetFetch(self, store):
+        with self._lock:
+            self._fetches.pop(store, None)
+
 
 class AospProject:
-    def __init__(self, basename, path, git_repo, remote, revision, options, logger):
+    def __init__(self, basename, path, metadata, remote, revision, options, logger, ref_cache=None):
         self._extracted = False
         self._forcedPatch = None
         self._basename = basename
         self._path = path
         self._args = options
         self.logger = logger
-        self._git_repo = git_repo
+        self._metadata = metadata
+        self._git_repo = None
         self._commit_courant = None
         self._commit_manifest = None
         self._commit_sincetag = None
         self._commit_totag = None
         self._commit_co = None
+        self._commit_head = None
+        self._commit_revision = None
+        self._resolved = False
+        self._tags = {}
+        self._tags_fetched = False
+        self._dirty = None
+        self._patch_files = 0
+        self._patch_bytes = 0
+        self._patch_lock = threading.Lock()
+        self._binaries_archive = None
+        self._binaries_removed = []
         self._revision = revision
         self._remote = remote
+        self._ref_cache = ref_cache
+
+        # Git commands are run in the object store when analysing without working trees
+        self._git_cwd = join(self._args['aosp'], self._path)
+        if self._args['bare']:
+            self._git_cwd = self._metadata.git_dir
 
         # Retrieve the remote url
         self._remote_url = ""
-        if self._git_repo.remotes:
-            self._remote_url = list(self._git_repo.remotes[0].urls)[0]
+        remotes = self._metadata.remotes()
+        if remotes:
+            urls = list(remotes.values())[0]
+            if urls:
+                self._remote_url = urls[0]
         else:
             self.logger.warning("No remote registered in {} ?!".format(self._path))
 
     def __repr__(self):
         return self._path
 
+    @property
+    def git_repo(self):
+        # Only opened when objects or history are needed
+        if self._git_repo is None:
+            self._git_repo = git.Repo(self._metadata.path)
+            if self._args['bare'] and not self._git_repo.bare:
+                # Non bare git folders would otherwise be used from their parent folder
+                self._git_repo.git.update_environment(GIT_DIR=self._git_repo.git_dir)
+        return self._git_repo
+
     @property
     def path(self):
         return self._path
@@ -74,6 +580,10 @@ class AospProject:
     def revision(self):
         return self._revision
 
+    @property
+    def remote(self):
+        return self._remote
+
     @property
     def remote_url(self):
         return self._remote_url
@@ -82,6 +592,18 @@ class AospProject:
     def basename(self):
         return self._basename
 
+    @property
+    def binaries_archive(self):
+        return self._binaries_archive
+
+    @property
+    def binaries_removed(self):
+        return self._binaries_removed
+
+    @property
+    def patch_bytes(self):
+        return self._patch_bytes
+
     @property
     def commit_manifest(self):
         return self._commit_manifest
@@ -137,19 +659,167 @@ class AospProject:
             ret = self._commit_co.hexsha[:9]
         return ret
 
+    def isShallow(self):
+        """
+        Check if this project is a shallow clone
+        :return: True if history is truncated
+        """
+        try:
+            return self._metadata.isShallow()
+        except Exception as e:
+            self.logger.error("Impossible to check shallow state of {}: {}".format(self._path, e))
+            return False
+
+    def fetchHistory(self, option):
+        """
+        Fetch more history from the project remote
+        :param option: git fetch history option (--deepen=N, --shallow-since=date, --unshallow)
+        :return: True if fetch succeeded
+        """
+        remote = ''
+        if self._remote in self._metadata.remotes():
+            remote = self._remote
+        try:
+            subprocess.check_output(
+                "cd {} && git fetch {} {}".format(self._git_cwd, remote, option),
+                shell=True)
+        except Exception as e:
+            self.logger.error("Impossible to fetch history ({}) in {}: {}".format(option, self._path, e))
+            return False
+        return True
+
     def unshallow(self):
         """
         This method process the unshallow querry on this folder
-        :param path: Absolute path of git repository to unshallow
-        :return:
+        :return: True if unshallow succeeded
+        """
+        self.logger.info("Unshallowing project {}".format(self._path))
+        return self.fetchHistory("--unshallow")
+
+    def deepen(self, reached, since=None):
+        """
+        Deepen a shallow history incrementally (shallow-since, then deepen-by with a growing step) until reached()
+        is satisfied. Full unshallow is only used when incremental fetches were not enough
+        :param reached: Callable returning True once history is deep enough
+        :param since: Optional date from which history should be sufficient
+        :return: True if history is deep enough
+        """
+        if reached():
+            return True
+
+        if since:
+            self.logger.info("Deepening {} since {}".format(self._path, since))
+            if self.fetchHistory("--shallow-since={}".format(since)) and reached():
+                return True
+
+        depth = int(self._args['deepen_step'])
+        for _ in range(DEEPEN_ROUNDS):
+            if not self.isShallow():
+                return reached()
+            self.logger.info("Deepening {} by {} commits".format(self._path, depth))
+            if not self.fetchHistory("--deepen={}".format(depth)):
+                break
+            if reached():
+                return True
+            depth *= 2
+
+        if self.isShallow() and self.unshallow():
+            return reached()
+        return False
+
+    def pendingCommits(self):
+        """
+        Cheap estimate of the work needed for this project: number of commits from manifest revision to delivered commit
+        :return: Number of commits
+        """
+        if not self._commit_manifest or not self._commit_courant or self._commit_manifest == self._commit_courant:
+            return 0
+        try:
+            return int(self.git_repo.git.rev_list('--count', '{}..{}'.format(self._commit_manifest.hexsha,
+                                                                              self._commit_courant.hexsha)))
+        except Exception as e:
+            self.logger.debug("! Impossible to count pending commits of {}: {}".format(self._path, e))
+            return 0
+
+    def historyDepth(self):
+        """
+        Compute how deep a shallow clone at manifest revision must be to contain the checkout commit
+        :return: Number of commits, 1 when checkout commit is the manifest one
         """
+        depth = 1
+        if self._commit_co and self._commit_manifest and self._commit_co != self._commit_manifest:
+            try:
+                depth += int(self.git_repo.git.rev_list('--count', '{}..{}'.format(self._commit_co.hexsha,
+                                                                                   self._commit_manifest.hexsha)))
+            except Exception as e:
+                self.logger.error("Impossible to compute history depth of {}: {}".format(self._path, e))
+        return depth
+
+    def objectsDir(self):
+        """
+        Retrieve the object store of this project, shared between projects using the same .repo/project-objects
+        :return: Real path of objects folder
+        """
+        return realpath(join(self._metadata.common_dir, 'objects'))
+
+    def isCommitGraphFresh(self, multi_pack_index=False):
+        """
+        Check if commit-graph files are newer than packs, loose objects and refs, and multi-pack-index if requested
+        newer than packs
+        :param multi_pack_index: Also check multi-pack-index freshness
+        :return: True if no refresh is needed
+        """
+        objects = self.objectsDir()
+        packs = glob(join(objects, 'pack', '*.pack'))
+        dates = [getmtime(p) for p in packs]
+        newest_pack = max(dates + [0])
+        for ref_file in [join(self._metadata.common_dir, 'packed-refs'), join(self._metadata.git_dir, 'FETCH_HEAD'),
+                         join(self._metadata.git_dir, 'HEAD')]:
+            if exists(ref_file):
+                dates.append(getmtime(ref_file))
+
+        # Loose objects and refs are written as new files, changing the date of their folder
+        dates += [getmtime(folder) for folder in glob(join(objects, '??'))]
+        for root, _, _ in walk(join(self._metadata.common_dir, 'refs')):
+            dates.append(getmtime(root))
+        newest = max(dates + [0])
+
+        graphs = [g for g in [join(objects, 'info', 'commit-graph'),
+                              join(objects, 'info', 'commit-graphs', 'commit-graph-chain')] if exists(g)]
+        if not graphs or max([getmtime(g) for g in graphs]) < newest:
+            return False
+
+        if multi_pack_index and packs:
+            midx = join(objects, 'pack', 'multi-pack-index')
+            if not exists(midx) or getmtime(midx) < newest_pack:
+                return False
+        return True
+
+    def writeCommitGraph(self, multi_pack_index=False):
+        """
+        Builds or refreshes commit-graph files of this project, speeding up later history traversals
+        :param multi_pack_index: Also write a multi-pack-index
+        :return: True if files were (re)written
+        """
+        if self.isCommitGraphFresh(multi_pack_index):
+            self.logger.debug("= Commit-graph of {} is up to date".format(self._path))
+            return False
+        if self._metadata.isShallow():
+            self.logger.debug("= No commit-graph for shallow project {}".format(self._path))
+            return False
         try:
-            self.logger.info("Unshallowing project")
+            self.logger.info("Writing commit-graph of {}".format(self._path))
             subprocess.check_output(
-                "cd {}/{} && git fetch --unshallow".format(self._args['aosp'], self._path),
+                "cd {} && git commit-graph write --reachable --split --no-progress".format(self._git_cwd),
                 shell=True)
+            if multi_pack_index and glob(join(self.objectsDir(), 'pack', '*.pack')):
+                subprocess.check_output(
+                    "cd {} && git multi-pack-index write --no-progress".format(self._git_cwd),
+                    shell=True)
         except Exception as e:
-            self.logger.error("Impossible to unshallow {}: {}".format(self._path, e))
+            self.logger.error("Impossible to write commit-graph in {}: {}".format(self._path, e))
+            return False
+        return True
 
     def getPatch(self, commit_src, commit_dst, file=''):
         """
@@ -161,47 +831,321 @@ class AospProject:
         """
         if file:
             patch = subprocess.check_output(
-                "cd {}/{} && git format-patch -k -s --full-index --stdout --binary"
-                " {}..{} -- {} ".format(self._args['aosp'], self._path, commit_src, commit_dst, file),
+                "cd {} && git format-patch -k -s --full-index --stdout --binary"
+                " {}..{} -- {} ".format(self._git_cwd, commit_src, commit_dst, file),
                 shell=True)
         else:
             patch = subprocess.check_output(
-                "cd {}/{} && git format-patch -k -s --full-index --stdout --binary"
-                " {}..{}".format(self._args['aosp'], self._path, commit_src, commit_dst),
+                "cd {} && git format-patch -k -s --full-index --stdout --binary"
+                " {}..{}".format(self._git_cwd, commit_src, commit_dst),
                 shell=True)
         return patch
 
-    def savePatch(self, commit_src, commit_dst, output_folder, patch_filename, file=''):
+    def savePatch(self, commit_src, commit_dst, output_folder, patch_filename, file='', excludes=None):
         """
         Store Patch content on file system (git outputs correctly utf-8 badly formatted character
-        conversion contrary to getPatch method)
+        conversion contrary to getPatch method), compressing it on the fly if requested
         :param commit_src: Starting commit id for patch generation
         :param commit_dst: Ending commit id for patch generation
         :param output_folder: absolute path where patch will be stored (created if needed)
         :param patch_filename: patch file name
         :param file: Optionnal file name to use as reference for patch production
-        :return:
+        :param excludes: Optionnal list of paths to leave out of the patch
+        :return: Stored file name, with compression suffix if any
         """
         # Creates output folder if needed
         os.makedirs(output_folder, exist_ok=True)
 
-        # Creates patch directly in output folder
+        pathspec = ''
         if file:
-            p = subprocess.Popen(
-                "cd {}/{} && git format-patch -k -s --full-index"
-                " --binary --stdout {}..{} -- {} > {}".format(self._args['aosp'], self._path,
-                                                              commit_src, commit_dst,
-                                                              file,
-                                                              join(output_folder, patch_filename)),
-                shell=True)
+            pathspec = ' -- {}'.format(file)
+        elif excludes:
+            pathspec = ' -- . ' + ' '.join([shlex.quote(':(exclude){}'.format(path)) for path in excludes])
+
+        compress = ''
+        if self._args['compress']:
+            compress = ' | {}'.format(COMPRESSORS[self._args['compress']][0])
+            patch_filename += COMPRESSORS[self._args['compress']][2]
+
+        # Squashed deliveries use a single tree to tree diff instead of a mailbox
+        if self._args['squash']:
+            command = "git diff --binary --full-index {} {}".format(commit_src, commit_dst)
         else:
-            p = subprocess.Popen(
-                "cd {}/{} && git format-patch -k -s --full-index"
-                " --binary {}..{} --stdout > {}".format(self._args['aosp'], self.path,
-                                                        commit_src, commit_dst,
-                                                        join(output_folder, patch_filename)),
-                shell=True)
-        p.wait()
+            command = "git format-patch -k -s --full-index --binary --stdout {}..{}".format(commit_src, commit_dst)
+
+        # Creates patch directly in output folder, a failure of git being reported through the compressor pipe
+        file_path = join(output_folder, patch_filename)
+        p = subprocess.run("set -o pipefail && cd {} && {}{}{} > {}".format(self._git_cwd, command, pathspec, compress,
+                                                                         shlex.quote(file_path)),
+                           shell=True, executable='/bin/bash', stderr=subprocess.PIPE, universal_newlines=True)
+        if p.returncode:
+            if exists(file_path):
+                os.unlink(file_path)
+            message = "Error while producing patch {} in {}: \n{}".format(patch_filename, self._path, p.stderr)
+            self.logger.error(message)
+            raise AospRepoToolError(message, 1)
+
+        # Keep track of produced volume for delivery report
+        if exists(join(output_folder, patch_filename)):
+            with self._patch_lock:
+                self._patch_files += 1
+                self._patch_bytes += getsize(join(output_folder, patch_filename))
+        return patch_filename
+
+    def patchFileName(self):
+        """
+        :return: Name of the single patch file of this project, a diff in squashed deliveries
+        """
+        if self._args['squash']:
+            return '{}.diff'.format(self._path.replace('/', '_'))
+        return '{}.patch'.format(self._path.replace('/', '_'))
+
+    def savePatchSeries(self, commit_src, commit_dst, output_folder):
+        """
+        Stores one numbered patch per commit between two commits, chunks of consecutive commits being produced
+        concurrently
+        :param commit_src: Starting commit id
+        :param commit_dst: Ending commit id
+        :param output_folder: absolute path where patches will be stored
+        :return: List of (starting commit, ending commit, stored file name) in commit order
+        """
+        # TODO check if there is merge commits and handle it properly
+        list_commits = list(self.git_repo.iter_commits("{}..{}".format(commit_src, commit_dst)))
+        list_commits.append(commit_src)
+        list_commits.reverse()
+        ranges = [(idx, list_commits[idx], list_commits[idx + 1]) for idx in range(len(list_commits) - 1)]
+
+        # Chunks of consecutive commits are produced concurrently, patches being recorded in commit order
+        workers = max(1, min(int(self._args['jobs']), len(ranges)))
+        size = max(1, len(ranges) // (workers * 4))
+        chunks = [ranges[idx:idx + size] for idx in range(0, len(ranges), size)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return [patch for chunk in executor.map(lambda chunk: self.savePatchRanges(chunk, output_folder), chunks)
+                    for patch in chunk]
+
+    def savePatchRanges(self, ranges, output_folder):
+        """
+        Stores one patch per commit range, ranges made of merge commits only producing no patch
+        :param ranges: List of (index, starting commit, ending commit), index numbering the patch file name
+        :param output_folder: absolute path where patches will be stored
+        :return: List of (starting commit, ending commit, stored file name)
+        """
+        patches = []
+        for idx, commit_src, commit_dst in ranges:
+            try:
+                # format-patch output is empty without non merge commits
+                count = int(self.git_repo.git.rev_list('--count', '--no-merges', '{}..{}'.format(commit_src,
+                                                                                                  commit_dst)))
+            except Exception as e:
+                message = 'Erreur de production du patch dans {}: \n{}'.format(self._path, str(e))
+                self.logger.error(message)
+                raise AospRepoToolError(message, 1)
+            if count:
+                try:
+                    file_name = '{:02d}_{}.patch'.format(idx, self._path.replace('/', '_'))
+                    patches.append((commit_src, commit_dst,
+                                    self.savePatch(commit_src, commit_dst, output_folder, file_name)))
+                except Exception as e:
+                    message = "Impossible to retrieve patch in {}: \n{}".format(self._path, e)
+                    self.logger.error(message)
+                    raise AospRepoToolError(message, -1)
+        return patches
+
+    def listBinaryChanges(self, commit_src, commit_dst):
+        """
+        Lists binary files changed by commits of a range, with the size of their new content
+        :param commit_src: Starting commit id
+        :param commit_dst: Ending commit id
+        :return: List of dictionaries with commit, path and size keys
+        """
+        output = subprocess.run(["git", "-c", "core.quotePath=false", "log", "--no-merges", "--no-renames", "--raw",
+                                 "--numstat", "--no-abbrev", "--format=#%H", "{}..{}".format(commit_src, commit_dst)],
+                                cwd=self._git_cwd, stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True).stdout
+        changes = []
+        commit = None
+        blobs = {}
+        for line in output.splitlines():
+            if line.startswith('#'):
+                commit = line[1:]
+                blobs = {}
+            elif line.startswith(':'):
+                meta, path = line.split('\t', 1)
+                blobs[path] = meta.split()[3]
+            elif line.startswith('-\t-\t'):
+                path = line[len('-\t-\t'):]
+                changes.append({'commit': commit, 'path': path, 'blob': blobs.get(path, '')})
+
+        # Retrieve sizes of new contents, deleted files having a null id
+        sizes = {}
+        blobs = set([change['blob'] for change in changes if change['blob'].strip('0')])
+        if blobs:
+            output = subprocess.run(["git", "cat-file", "--batch-check"], input="\n".join(blobs) + "\n",
+                                    cwd=self._git_cwd, stdout=subprocess.PIPE, check=True,
+                                    universal_newlines=True).stdout
+            for line in output.splitlines():
+                fields = line.split()
+                if len(fields) == 3 and fields[2].isdigit():
+                    sizes[fields[0]] = int(fields[2])
+        for change in changes:
+            change['size'] = sizes.get(change.pop('blob'), 0)
+        return changes
+
+    def checkPatchSize(self, manager, output_folder, patch_filename, commit_src, commit_dst):
+        """
+        Flags a patch exceeding --max_patch_size and reports the large binary changes responsible for it
+        :param manager: AospRepoTool parent object
+        :param output_folder: Folder of the patch
+        :param patch_filename: Patch file name
+        :param commit_src: Starting commit id of the patch
+        :param commit_dst: Ending commit id of the patch
+        :return: List of large binary changes (see listBinaryChanges), empty if patch size is acceptable
+        """
+        max_size = float(self._args['max_patch_size']) * 1024 * 1024
+        if not max_size:
+            return []
+        patch_size = getsize(join(output_folder, patch_filename))
+        if patch_size <= max_size:
+            return []
+
+        min_size = float(self._args['large_binary_size']) * 1024 * 1024
+        binaries = [change for change in self.listBinaryChanges(commit_src, commit_dst) if change['size'] >= min_size]
+        binaries.sort(key=lambda change: change['size'], reverse=True)
+        self.logger.warning("! Patch {} of {} is {} bytes, {} large binary changes".format(
+            patch_filename, self._path, patch_size, len(binaries)))
+        for change in binaries:
+            self.logger.warning("!   {} {} ({} bytes)".format(change['commit'][:9], change['path'], change['size']))
+        manager.addLargeBinaries(self, patch_filename, patch_size, binaries)
+        return binaries
+
+    def rerouteLargeBinaries(self, binaries, output_folder, patch_filename):
+        """
+        Produces the patch again without large binary files, their delivered content being stored in an archive
+        applied by the patching script after the patch
+        :param binaries: Large binary changes (see listBinaryChanges)
+        :param output_folder: Folder of the patch
+        :param patch_filename: Patch file name to replace
+        :return: New patch file name, None if large binaries were the only changes
+        """
+        paths = sorted(set([change['path'] for change in binaries]))
+        self._patch_files -= 1
+        self._patch_bytes -= getsize(join(output_folder, patch_filename))
+        os.unlink(join(output_folder, patch_filename))
+
+        # Remaining changes are checked the same way as the whole patch
+        pathspec = ['--', '.'] + [':(exclude){}'.format(path) for path in paths]
+        if self._args['squash']:
+            remaining = self.git_repo.git.diff('--name-only', self.s_commit_co, self.s_commit_courant, *pathspec)
+        else:
+            remaining = int(self.git_repo.git.rev_list('--count', '--no-merges', '{}..{}'.format(
+                self.s_commit_co, self.s_commit_courant), *pathspec))
+        if remaining:
+            patch_filename = self.savePatch(self.s_commit_co, self.s_commit_courant, output_folder,
+                                            self.patchFileName(), excludes=paths)
+        else:
+            self.logger.info("! Only large binaries changed in {}, no patch left".format(self._path))
+            patch_filename = None
+
+        # Only files still existing in delivered version are archived, others are removed by patching script
+        existing = self.git_repo.git.ls_tree('--name-only', '-r', '-z', self._commit_courant.hexsha, '--',
+                                              *paths).split('\0')
+        existing = [path for path in existing if path]
+        self._binaries_removed = [path for path in paths if path not in existing]
+        if existing:
+            self._binaries_archive = '{}_binaries.tar.gz'.format(self._path.replace('/', '_'))
+            self.git_repo.git.archive('--format=tar.gz', '-o', join(output_folder, self._binaries_archive),
+                                       self._commit_courant.hexsha, '--', *existing)
+            self.logger.warning("! {} large binaries of {} moved to {}".format(len(existing), self._path,
+                                                                             self._binaries_archive))
+        return patch_filename
+
+    def preflight(self):
+        """
+        Checks this project before any processing: working tree state, manifest revision, tags, shallow history and
+        remote configuration
+        :return: List of (level, message) problems, logging.ERROR ones being blocking
+        """
+        problems = []
+        try:
+            self.extractCommits()
+        except AospRepoToolError as e:
+            return [(logging.ERROR, str(e))]
+
+        if self._commit_manifest is None:
+            problems.append((logging.ERROR, "manifest revision {} not found".format(self._revision)))
+        for option, commit in [('since_tag', self._commit_sincetag), ('to_tag', self._commit_totag)]:
+            if self._args[option] and commit is None:
+                problems.append((logging.WARNING, "{} {} not found".format(option, self._args[option])))
+
+        try:
+            if self.isDirty():
+                problems.append((logging.WARNING, "not clean, ignored"))
+        except AospRepoToolError:
+            problems.append((logging.ERROR, "not clean"))
+
+        if not self._args['unshallow'] and self.isShallow():
+            problems.append((logging.WARNING, "shallow history, ancestors may be out of reach (see --unshallow)"))
+
+        if not self._remote_url:
+            level = logging.WARNING
+            if self._args['unshallow'] or self._args['track_remote']:
+                level = logging.ERROR
+            problems.append((level, "no remote configured"))
+        return problems
+
+    def verifyPatches(self, patch_files, manager):
+        """
+        Applies delivered patches of this project as the patching script does, in a scratch worktree at checkout
+        commit, and compares the result with the delivered tree
+        :param patch_files: Patch file paths in application order
+        :param manager: AospRepoTool parent object
+        :return: Dictionary with path, status ('pass' or 'fail'), patches, applied, tree_match, error and duration
+        """
+        start = time.time()
+        result = {'path': self._path, 'status': 'fail', 'patches': len(patch_files), 'applied': 0,
+                  'tree_match': False, 'error': None}
+        scratch = tempfile.mkdtemp(prefix='verify_{}_'.format(self._path.replace('/', '_')))
+        worktree = join(scratch, 'worktree')
+
+        # Patches keep their author, scratch commits only need a committer
+        env = dict(os.environ)
+        for key, value in [('GIT_COMMITTER_NAME', 'AospRepoTool'), ('GIT_COMMITTER_EMAIL', 'aosprepotool@localhost'),
+                           ('GIT_AUTHOR_NAME', 'AospRepoTool'), ('GIT_AUTHOR_EMAIL', 'aosprepotool@localhost')]:
+            env.setdefault(key, value)
+        try:
+            subprocess.run(["git", "worktree", "add", "--detach", "--quiet", worktree, self._commit_co.hexsha],
+                           cwd=self._git_cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            for patch_file in patch_files:
+                proc = subprocess.run(manager.applyPatchCommand(shlex.quote(patch_file), self), shell=True,
+                                      cwd=worktree, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                      universal_newlines=True)
+                if proc.returncode:
+                    lines = proc.stdout.strip().splitlines()
+                    errors = [line for line in lines if line.startswith('error:') or line.startswith('Patch failed')]
+                    result['error'] = "{}: {}".format(os.path.basename(patch_file), "; ".join(errors or lines[-1:]))
+                    break
+                result['applied'] += 1
+            else:
+                if self._binaries_archive or self._binaries_removed:
+                    archive = None
+                    if self._binaries_archive:
+                        archive = shlex.quote(join(self._args['output_folder'], self._binaries_archive))
+                    subprocess.run(manager.binariesCommand(self, archive, shlex.quote(worktree)), shell=True,
+                                   cwd=worktree, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+                result['status'] = 'pass'
+                tree = subprocess.run(["git", "rev-parse", "HEAD^{tree}"], cwd=worktree, stdout=subprocess.PIPE,
+                                      check=True, universal_newlines=True).stdout.strip()
+                result['tree_match'] = tree == self._commit_courant.tree.hexsha
+        except subprocess.CalledProcessError as e:
+            result['error'] = "{}: {}".format(e.cmd, (e.stderr or e.stdout or b'').decode(errors='replace').strip())
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=self._git_cwd,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            shutil.rmtree(scratch, ignore_errors=True)
+            subprocess.run(["git", "worktree", "prune"], cwd=self._git_cwd, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+        result['duration'] = round(time.time() - start, 3)
+        return result
 
     def needPatch(self, setNeedPatch=None):
         """
@@ -210,9 +1154,10 @@ class AospProject:
         """
         if setNeedPatch is not None:
             self._forcedPatch = setNeedPatch
+            needPatch = setNeedPatch
         else:
-            if self._forcedPatch:
-                return self._forcedPatc
+            if self._forcedPatch is not None:
+                return self._forcedPatch
 
             if self._path == "kernel/msm-4.14":
                 a = 1
@@ -257,8 +1202,9 @@ class AospProject:
         # Check for error case
         if self._commit_manifest is None:
             # Seems that this AOSP project is out of control => exit
-            self.logger.error("! Impossible to locate manifest revision {} in {}".format(self._revision, self._path))
-            exit(1)
+            message = "! Impossible to locate manifest revision {} in {}".format(self._revision, self._path)
+            self.logger.error(message)
+            raise AospRepoToolError(message, 1)
 
     def setCommitCo(self, commit):
         """
@@ -270,27 +1216,35 @@ class AospProject:
 
     def isDirty(self):
         """
-        This method check for exit conditions and exits if needed
+        This method check for exit conditions and exits if needed. Result is kept for later deliveries of this run
         :return: None
         """
+        if self._dirty is not None:
+            return self._dirty
+
+        # No working tree to check in object stores
+        if self._args['bare']:
+            self._dirty = False
+            return False
+
         # Check for uncommited or untracked files
         is_dirty = False
-        if self._git_repo.is_dirty(untracked_files=not self._args['ignore_untrack']):
+        if self.git_repo.is_dirty(untracked_files=not self._args['ignore_untrack']):
             is_dirty = True
             if not self._args['inspect_repo']:
                 if self._args['ignore_symlink']:
                     is_dirty = False
-                    for f in self._git_repo.untracked_files:
+                    for f in self.git_repo.untracked_files:
                         if not islink(join(self._args['aosp'], self._path, f)):
                             is_dirty = True
                             break
                 if is_dirty and not self._args['ignore_dirty']:
                     self.logger.warning("! {} n'est pas propre => exit".format(self._path))
-                    exit(-1)
+                    raise AospRepoToolError("{} is not clean".format(self._path), -1)
             else:
                 if self._args['ignore_symlink']:
                     is_dirty = False
-                    for f in self._git_repo.untracked_files:
+                    for f in self.git_repo.untracked_files:
                         if not islink(join(self._args['aosp'], self._path, f)):
                             is_dirty = True
                             break
@@ -298,29 +1252,41 @@ class AospProject:
                     self.logger.warning("! {} n'est pas propre".format(self._path))
                 else:
                     self.logger.info("!  Symlink found in {}".format(self._path))
+        self._dirty = is_dirty
         return is_dirty
 
     def checkout(self, commit):
         if self.isDirty():
-            for f in self._git_repo.untracked_files:
+            for f in self.git_repo.untracked_files:
                 os.unlink(join(self._args['aosp'], self._path, f))
-        self._git_repo.checkout(commit)
+        self.git_repo.checkout(commit)
 
     def fetchTags(self):
         """
-        This method feeds all available tags from git repo
-        :param path: Full path to the git repo
+        This method feeds all available tags from git repo, once per run
         :return: void
         """
-        try:
+        if self._tags_fetched:
+            return
+        self._tags_fetched = True
+
+        def fetch():
             self.logger.debug("Fetching tags")
             # Let's fetch
             subprocess.check_output(
-                "cd {}/{} && git fetch -j {} --tags".format(self._args['aosp'], self._path, self._args['jobs']),
+                "cd {} && git fetch -j {} --tags".format(self._git_cwd, self._args['jobs']),
                 shell=True)
+
+        try:
+            # Projects sharing a git folder (duplicated paths, worktrees) fetch once
+            if self._ref_cache:
+                self._ref_cache.fetchOnce(realpath(self._metadata.common_dir), fetch)
+            else:
+                fetch()
         except Exception as e:
-            self.logger.error("Error while fetching tags in {}: {}".format(self._path, e))
-            exit(1)
+            message = "Error while fetching tags in {}: {}".format(self._path, e)
+            self.logger.error(message)
+            raise AospRepoToolError(message, 1)
 
     def extractCommits(self):
         """
@@ -329,43 +1295,33 @@ class AospProject:
         :return:
         """
         if not self._extracted:
-            # Retrieve HEAD commit
-            self._commit_courant = self._git_repo.head.commit
-
-            # Force use of fully qualified branch name in order to prevent local homonyme branch
-            for prefix in [self._remote + '/', 'm/', self._remote + 'm/', 'refs/tags/', 'refs/heads/', '']:
-                try:
-                    self._commit_manifest = self._git_repo.commit(prefix + self._revision)
-                    self.logger.debug("+ {} manifest revision  {} ({})".format(self._path, prefix + self._revision,
-                                                                               self.s_commit_manifest))
-                    break
-                except:
-                    pass
+            # Retrieve HEAD and manifest revision commits
+            self.resolveRevisions()
+            self._commit_courant = self._commit_head
+            self._commit_manifest = self._commit_revision
 
             since_tag = self._args['since_tag']
             to_tag = self._args['to_tag']
 
-            # Ensure corresponding tags are fetched
-            if since_tag or to_tag:
+            # Ensure corresponding tags are fetched, inspection only relies on local refs
+            if (since_tag or to_tag) and not self._args['inspect_repo']:
                 self.fetchTags()
 
             if since_tag:
-                try:
-                    self._commit_sincetag = self._git_repo.commit('refs/tags/' + since_tag)
+                self._commit_sincetag = self.resolveTag(since_tag)
+                if self._commit_sincetag:
                     self.logger.debug("+ {} \'since tag\' found {} ({})".format(self._path, since_tag,
                                                                                 self.s_commit_sincetag))
-                except:
-                    pass
 
             if to_tag:
-                try:
-                    self._commit_totag = self._git_repo.commit('refs/tags/' + to_tag)
+                self._commit_totag = self.resolveTag(to_tag)
+                if self._commit_totag:
                     self.logger.debug("+ {} to tag found revision  {} ({})".format(self._path, to_tag,
                                                                                    self.s_commit_totag))
                     if self._commit_totag != self._commit_courant:
                         self.logger.info("Target tag is not current commit?!")
                         self._commit_courant = self._commit_totag
-                except:
+                else:
                     self.logger.debug("! Impossible to retrieve to_tag {} in {}".format(to_tag, self._path))
 
             # Consider the manifest is pointing to sincetag if available
@@ -375,6 +1331,184 @@ class AospProject:
             # Record extraction has been done
             self._extracted = True
 
+    def resolveRevisions(self):
+        """
+        Resolves HEAD and manifest revision commits, once per run
+        :return:
+        """
+        if self._resolved:
+            return
+
+        # Retrieve HEAD commit, an object store may have none
+        self._commit_head = self.resolveCommit('HEAD')
+        if self._commit_head is None:
+            self.logger.warning("! No HEAD commit in {}".format(self._path))
+
+        # Force use of fully qualified branch name in order to prevent local homonyme branch
+        for prefix in [self._remote + '/', 'm/', self._remote + 'm/', 'refs/tags/', 'refs/heads/', '']:
+            self._commit_revision = self.resolveCommit(prefix + self._revision)
+            if self._commit_revision:
+                self.logger.debug("+ {} manifest revision  {} ({})".format(self._path, prefix + self._revision,
+                                                                           self._commit_revision.hexsha[:9]))
+                break
+        self._resolved = True
+
+    def resolveCommit(self, name):
+        """
+        Resolves a revision to a commit, refs being read from git metadata and git being only used for object ids
+        and tags which are not peeled in metadata
+        :param name: Revision
+        :return: Commit or None if revision cannot be resolved
+        """
+        ref = self._metadata.resolveRef(name)
+        if ref and ref[2]:
+            return git.Commit(self.git_repo, hex_to_bin(ref[2]))
+
+        # Objects peeled by git in a previous run or by a project sharing the object store
+        store = self.objectsDir()
+        if ref and self._ref_cache:
+            commit_id = self._ref_cache.get(store, ref[1])
+            if commit_id:
+                return git.Commit(self.git_repo, hex_to_bin(commit_id))
+
+        if ref or all([c in '0123456789abcdefABCDEF' for c in name]) or '^' in name or '~' in name:
+            try:
+                commit = self.git_repo.commit(name)
+            except Exception:
+                return None
+            if ref and self._ref_cache:
+                self._ref_cache.put(store, ref[1], commit.hexsha)
+            return commit
+        return None
+
+    def resolveTag(self, tag):
+        """
+        Resolves a tag to its commit, keeping the result for later deliveries of this run
+        :param tag: Tag name
+        :return: Commit or None if tag does not exist in this project
+        """
+        if tag not in self._tags:
+            self._tags[tag] = self.resolveCommit('refs/tags/' + tag)
+        return self._tags[tag]
+
+    def resetDelivery(self):
+        """
+        Forgets delivery dependent state (tags selection, checkout point, patch decision) while keeping resolved
+        revisions, dirty state and repository handle for a new delivery of the same tree
+        :return:
+        """
+        self._extracted = False
+        self._forcedPatch = None
+        self._commit_courant = None
+        self._commit_manifest = None
+        self._commit_sincetag = None
+        self._commit_totag = None
+        self._commit_co = None
+        self._patch_files = 0
+        self._patch_bytes = 0
+        self._binaries_archive = None
+        self._binaries_removed = []
+
+    def refresh(self):
+        """
+        Forgets every resolution of this project (HEAD, revisions, tags, dirty state) after a change in repository
+        :return:
+        """
+        self.resetDelivery()
+        self._resolved = False
+        self._commit_head = None
+        self._commit_revision = None
+        self._tags = {}
+        self._tags_fetched = False
+        self._dirty = None
+        if self._ref_cache:
+            self._ref_cache.forgetFetch(realpath(self._metadata.common_dir))
+
+    def refsSignature(self):
+        """
+        Cheap signature of HEAD and refs state of this project, changing when a commit, checkout or fetch happens.
+        HEAD and its branch are compared by content, rewriting them with the same commit is not a change
+        :return: Tuple of HEAD content, branch content and fetch related modification times
+        """
+        def content(file_name):
+            try:
+                with open(file_name, 'r') as fd:
+                    return fd.read().strip()
+            except OSError:
+                return None
+
+        head = content(join(self._metadata.git_dir, 'HEAD'))
+        signature = [head]
+        if head and head.startswith('ref: '):
+            signature.append(content(join(self._metadata.common_dir, head[len('ref: '):])))
+        for file_name in [join(self._metadata.git_dir, 'FETCH_HEAD'), join(self._metadata.common_dir, 'packed-refs')]:
+            try:
+                signature.append(os.stat(file_name).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def inspect(self):
+        """
+        Classifies this project using local refs and cheap ancestry queries only
+        :return: One of 'missing revision', 'dirty', 'clean', 'ahead', 'behind', 'diverged'
+        """
+        self.extractCommits()
+        if self._commit_manifest is None:
+            return 'missing revision'
+        if self.isDirty():
+            return 'dirty'
+        if self._commit_courant == self._commit_manifest:
+            return 'clean'
+        if self.git_repo.is_ancestor(self._commit_manifest, self._commit_courant):
+            return 'ahead'
+        if self.git_repo.is_ancestor(self._commit_courant, self._commit_manifest):
+            return 'behind'
+        return 'diverged'
+
+    def isOnRemote(self, commit):
+        """
+        Check if a commit is reachable from a remote branch, hence available on mirrors
+        :param commit: Commit to check
+        :return: True if a remote branch contains it
+        """
+        # Branches of mirrors are the remote ones
+        refs = ['refs/remotes/']
+        if self._metadata.bare:
+            refs.append('refs/heads/')
+        try:
+            return bool(self.git_repo.git.for_each_ref('--count=1', '--contains', commit.hexsha, *refs))
+        except Exception as e:
+            self.logger.debug("! Impossible to check {} on remotes of {}: {}".format(commit.hexsha[:9], self._path, e))
+            return False
+
+    def reportEntry(self, duration):
+        """
+        Builds delivery report entry of this project
+        :param duration: Processing time of the project in seconds
+        :return: Dictionary
+        """
+        entry = {'kind': 'project', 'path': self._path, 'manifest': self._basename, 'remote_url': self._remote_url}
+        for name, commit in [('manifest_sha', self._commit_manifest), ('co_sha', self._commit_co),
+                             ('current_sha', self._commit_courant), ('since_sha', self._commit_sincetag),
+                             ('to_sha', self._commit_totag)]:
+            entry[name] = commit.hexsha if commit else None
+
+        entry['commits'] = 0
+        entry['binary_files'] = 0
+        if self._commit_co and self._commit_courant and self._commit_co != self._commit_courant:
+            try:
+                entry['commits'] = int(self.git_repo.git.rev_list('--count', '{}..{}'.format(
+                    self._commit_co.hexsha, self._commit_courant.hexsha)))
+                numstat = self.git_repo.git.diff('--numstat', self._commit_co.hexsha, self._commit_courant.hexsha)
+                entry['binary_files'] = len([line for line in numstat.splitlines() if line.startswith('-\t-\t')])
+            except Exception as e:
+                self.logger.error("Impossible to compute report statistics of {}: {}".format(self._path, e))
+        entry['patch_files'] = self._patch_files
+        entry['patch_bytes'] = self._patch_bytes
+        entry['duration'] = round(duration, 3)
+        return entry
+
     def searchAncestors(self, manager):
         """
         This method analyse history to find the commit on which patch should be produced and record in
@@ -382,8 +1516,6 @@ class AospProject:
         :param manager: AospRepoTool object
         :return:
         """
-        list_commits_manifest = []
-
         # No ops if already done
         self.extractCommits()
 
@@ -391,12 +1523,20 @@ class AospProject:
         if self.commit_totag is None:
             self._commit_totag = self._commit_courant
 
-        # Handle case where current commit is older as manifest one
-        try:
-            list_commits_manifest = list(self._git_repo.iter_commits(self._commit_manifest))
-        except Exception as e:
+        # Shallow history may hide the divergence point: deepen it just enough to reach a common ancestor
+        if self._args['unshallow'] and self._commit_manifest and self.isShallow():
+            if not self.deepen(lambda: bool(self.git_repo.merge_base(self._commit_manifest, self._commit_courant))):
+                self.logger.warning("! No common ancestor reachable in {} history".format(self._path))
+
+        # Stream both histories until they meet
+        status, commit = self.searchDivergence()
+
+        if status == 'missing':
             self.logger.error(
                 "Impossible to find initial commit!! {} in {}".format(self.s_commit_manifest, self._path))
+            # Without terminal (library use, CI) or from a worker of concurrent processing, go on with next projects
+            if not sys.stdin.isatty() or threading.current_thread() is not threading.main_thread():
+                return
             while True:
                 resp = input("Continue? (O/N)").lower()
                 if resp in ['n', 'o', 'y']:
@@ -406,52 +1546,129 @@ class AospProject:
             else:
                 # Exits on critical situation
                 self.logger.error("=> Exit")
-                exit(-1)
+                raise AospRepoToolError("Initial commit {} not found in {}".format(self.s_commit_manifest,
+                                                                                   self._path), -1)
 
-        # Search in history if the current commit is found
-        if self._commit_courant in list_commits_manifest:
+        # Handle case where current commit is older as manifest one
+        if status == 'behind':
             # If the current point is before manifest revision
-            if self._commit_courant != list_commits_manifest[0]:
+            if self._commit_courant != self._commit_manifest:
                 self.logger.warning("! Use of an older version {} {}"
                                     " -> {}".format(self._path, self.s_commit_manifest, self.s_commit_courant))
             # Add to tracked project list in order to add unshallow instructions
             manager.addTrackRemote(self._path)
             # Store that patcher script should co on this early point of time
             self._commit_co = self._commit_courant
-        else:
-            # Search for a history divergence point and use it as starting point for patch production and patcher
-            # script checkout instructions
-            list_commits_head = list(self._git_repo.iter_commits(self._commit_courant))
-            if self._commit_manifest not in list_commits_head:
-                self._commit_co = None
-                # Divergence found
-                commit_ancetre_commun = None
-                for commit in list_commits_manifest:
-                    if commit in list_commits_head:
-                        # Common ancestor is found.
-                        commit_ancetre_commun = commit
-                        break
-                # Complete history divergence, use the oldest commit if opt in
-                if not commit_ancetre_commun:
+        elif status != 'ahead':
+            # Use the history divergence point as starting point for patch production and patcher script checkout
+            # instructions
+            self._commit_co = None
+            commit_ancetre_commun = None
+            if status == 'diverged':
+                # Common ancestor is found.
+                commit_ancetre_commun = commit
+            else:
+                # Complete history divergence or search limit reached, use the oldest commit walked if opt in
+                if status == 'too_deep':
+                    self.logger.error("! Divergence too deep: no common ancestor found within search limits in "
+                                      "{}".format(self._path))
+                else:
                     self.logger.error(
                         "! Attention: impossible de trouver un ancètre commun dans les "
                         "historiques de {}?!".format(self._path))
-                    if self._args['oldest_commit']:
-                        commit_ancetre_commun = list_commits_manifest[-1]
-                    else:
-                        self.logger.error("Ignoring patches from {}".format(self._path))
-                        # Record no need to patch
-                        self.needPatch(False)
-                        return
-
-                # Recording where to checkout
-                self._commit_co = commit_ancetre_commun
-                self.logger.warning("! Delivery diverged from manifest "
-                                    "{} ancest|{} -> manif|{}/curent|{}".format(self._path, self.s_commit_co,
-                                                                                self.s_commit_manifest,
-                                                                                self.s_commit_courant))
-                # Add to unshallowable projects in genetated patcher script
-                manager.addTrackRemote(self._path)
+                if self._args['oldest_commit'] and commit:
+                    commit_ancetre_commun = commit
+                else:
+                    self.logger.error("Ignoring patches from {}".format(self._path))
+                    # Record no need to patch
+                    self.needPatch(False)
+                    return
+
+            # Recording where to checkout
+            self._commit_co = self.git_repo.commit(commit_ancetre_commun)
+            self.logger.warning("! Delivery diverged from manifest "
+                                "{} ancest|{} -> manif|{}/curent|{}".format(self._path, self.s_commit_co,
+                                                                            self.s_commit_manifest,
+                                                                            self.s_commit_courant))
+            # Add to unshallowable projects in genetated patcher script
+            manager.addTrackRemote(self._path)
+
+    def streamHistory(self, commit):
+        """
+        Generator streaming commit ids of the history of a commit, newest first, without loading it in memory
+        :param commit: Starting commit
+        :return: Iterator on hexsha strings
+        """
+        proc = subprocess.Popen(["git", "rev-list", commit.hexsha], cwd=self._git_cwd,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            for line in proc.stdout:
+                yield line.strip().decode()
+        finally:
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+
+    def searchDivergence(self):
+        """
+        Checks if a commit contains the other one, then walks manifest and current histories side by side, keeping
+        only commit ids of walked commits, until they meet. Only this walk is bounded by --max_depth commits per side
+        and --max_memory MB of walked ids
+        :return: Tuple (status, commit id) with status among:
+            'behind': current commit is in manifest history
+            'ahead': manifest commit is in current history
+            'diverged': histories diverged, commit id is the common ancestor
+            'unrelated': no common ancestor, commit id is the oldest commit of manifest history
+            'too_deep': search limits reached, commit id is the oldest manifest commit walked
+            'missing': manifest history can't be walked
+        """
+        max_depth = int(self._args['max_depth'])
+        max_entries = int(self._args['max_memory']) * 1024 * 1024 // SEEN_ENTRY_SIZE
+        manifest_sha = self._commit_manifest.hexsha
+        courant_sha = self._commit_courant.hexsha
+
+        # Ahead and behind cases do not depend on limits, git answers them from commit-graph when available
+        try:
+            if self.git_repo.is_ancestor(courant_sha, manifest_sha):
+                return 'behind', courant_sha
+            if self.git_repo.is_ancestor(manifest_sha, courant_sha):
+                return 'ahead', manifest_sha
+        except Exception as e:
+            self.logger.debug("! Ancestry check failed in {}: {}".format(self._path, e))
+
+        walks = [self.streamHistory(self._commit_manifest), self.streamHistory(self._commit_courant)]
+        seen = [set(), set()]
+        oldest_manifest = None
+        depth = 0
+        try:
+            while walks[0] or walks[1]:
+                depth += 1
+                if (max_depth and depth > max_depth) or (max_entries and len(seen[0]) + len(seen[1]) > max_entries):
+                    self.logger.debug("! Divergence search stopped in {} after {} commits".format(self._path, depth))
+                    return 'too_deep', oldest_manifest
+                for side in [0, 1]:
+                    if not walks[side]:
+                        continue
+                    sha = next(walks[side], None)
+                    if sha is None:
+                        walks[side] = None
+                        continue
+                    if side == 0:
+                        oldest_manifest = sha
+                    if sha in seen[1 - side]:
+                        if sha == courant_sha:
+                            return 'behind', sha
+                        if sha == manifest_sha:
+                            return 'ahead', sha
+                        return 'diverged', sha
+                    seen[side].add(sha)
+                if oldest_manifest is None:
+                    return 'missing', None
+        finally:
+            for stream in walks:
+                if stream:
+                    stream.close()
+        return 'unrelated', oldest_manifest
 
     def process(self, manager):
         """
@@ -464,7 +1681,7 @@ class AospProject:
         is_dirty = self.isDirty()
         if is_dirty and not self._args['ignore_dirty']:
             self.logger.warning("! {} is not clean => exit".format(self._path))
-            exit(-1)
+            raise AospRepoToolError("{} is not clean".format(self._path), -1)
 
         # Filter out projects without interesting modifications
         if (self._args['to_tag'] and self._commit_totag and self._commit_manifest and
@@ -481,8 +1698,7 @@ class AospProject:
                     manager.addTrackRemote(self.path)
                     if self._args['to_tag'] and self._commit_totag != self._commit_manifest:
                         # Check if delivery tag is above reference branch (manifest revision)
-                        list_commits_head = list(self._git_repo.iter_commits(self._commit_manifest))
-                        if self._commit_totag in list_commits_head:
+                        if self.git_repo.is_ancestor(self._commit_totag, self._commit_manifest):
                             # Manifest points on newer commit than to_tag, keep to_tag as original checkout point as
                             # it must be added in patching script
                             self.setCommitCo(self._commit_totag)
@@ -525,65 +1741,82 @@ class AospProject:
         self.logger.info("Production of patchs for {}".format(self._path))
 
         if self._args['diff_format']:
-            list_commits = list(self._git_repo.iter_commits("{}..{}".format(self.s_commit_co, self.s_commit_courant)))
-            list_commits.append(self.s_commit_co)
-            list_commits.reverse()
-
             # Create a patch file per commit id
-            # TODO check if there is merge commits and handle it properly
-            for idx, commit in enumerate(list_commits):
-                if idx + 1 >= len(list_commits):
-                    break
-                try:
-                    patch = self.getPatch(list_commits[idx], list_commits[idx + 1])
-                except Exception as e:
-                    self.logger.error('Erreur de production du patch dans {}: \n{}'.format(self._path, str(e)))
-                    exit(1)
-                if patch:
-                    try:
-                        dest_path = join(output_path, self._path.replace(self._args['aosp'], ''))
-                        file_name = '{:02d}_{}.patch'.format(idx, self._path.replace('/', '_'))
-                        self.savePatch(list_commits[idx], list_commits[idx + 1], dest_path, file_name)
-                        manager.addPatch((self, file_name, True))
-                    except Exception as e:
-                        self.logger.error("Impossible to retrieve patch in {}: \n{}".format(self._path, e))
-                        exit(-1)
+            dest_path = join(output_path, self._path.replace(self._args['aosp'], ''))
+            patches = self.savePatchSeries(self.s_commit_co, self.s_commit_courant, dest_path)
+            for commit_src, commit_dst, file_name in patches:
+                self.checkPatchSize(manager, dest_path, file_name, commit_src, commit_dst)
+                manager.addPatch((self, file_name, True))
         else:
             try:
-                # Single patch file
-                patch = self.getPatch(self.s_commit_co, self.s_commit_courant)
+                if self._args['squash']:
+                    # Single diff file, only produced if trees differ
+                    patch = self._commit_co.tree != self._commit_courant.tree
+                else:
+                    # Single patch file, only produced if there are non merge commits
+                    patch = int(self.git_repo.git.rev_list('--count', '--no-merges', '{}..{}'.format(
+                        self.s_commit_co, self.s_commit_courant)))
             except Exception as e:
-                self.logger.error('Error while producing patch in {}: \n{}'.format(self._path, str(e)))
-                exit(1)
+                message = 'Error while producing patch in {}: \n{}'.format(self._path, str(e))
+                self.logger.error(message)
+                raise AospRepoToolError(message, 1)
             finally:
-                self._git_repo.head.commit = self._commit_courant
+                if not self._args['bare']:
+                    self.git_repo.head.commit = self._commit_courant
 
             if patch:
-                filename = '{}.patch'.format(self._path.replace('/', '_'))
-                self.savePatch(self.s_commit_co, self.s_commit_courant, output_path, filename)
+                filename = self.patchFileName()
+                filename = self.savePatch(self.s_commit_co, self.s_commit_courant, output_path, filename)
+                binaries = self.checkPatchSize(manager, output_path, filename, self.s_commit_co,
+                                               self.s_commit_courant)
+                if binaries and self._args['large_binaries_archive']:
+                    filename = self.rerouteLargeBinaries(binaries, output_path, filename)
                 manager.addPatch((self, filename, True))
         self.logger.info("Production of patchs for {} : DONE".format(self._path))
 
 
 class AospRepoTool:
-    def __init__(self, **kwargs):
-        self.logger = None
+    def __init__(self, config=None, **kwargs):
+        """
+        Command line use: build without options and call initArgParser. Library use: options are taken from config
+        and kwargs, missing ones having command line default values
+        :param config: Optional dictionary or object (e.g. argparse Namespace) holding options
+        :param kwargs: Options overloading config, 'logger' being the logger to use
+        """
+        self.logger = kwargs.pop('logger', None) or logging.getLogger(name="AospRepoTool.py")
         self._args = {}
-        if kwargs:
-            self._args == kwargs
-
-        if self._args.get("logger", None) is not None:
-            self.logger = self._args["logger"]
-
         self._parser = None
+        if config is not None or kwargs:
+            # Start from command line defaults, no usage printing in library use
+            self.initArgParser([])
+            self._parser = None
+            if config is not None:
+                self._args.update(config if isinstance(config, dict) else vars(config))
+            self._args.update(kwargs)
+
+        self._analysed = False
+        self._delivered = False
+        self._lock = threading.Lock()
+        self._errors = []
         self._list_manifests = []
         self._list_projects = []
         self._list_removed_projects = []
         self._list_patch = []
-        self._list_remaining_git_folders = []
+        self._list_remaining_git_folders = OrderedDict()
+        self._manifest_paths = set()
+        self._project_paths = set()
+        self._groups = []
+        self._scope_selection = (set(), None)
+        self._skip_selection = (set(), None)
         self._list_archives = []
         self._list_track_remote = []
         self._list_oem_projects = []
+        self._list_large_binaries = []
+        self._checksums = OrderedDict()
+        self._pipeline_archives = set()
+        self._ref_cache = None
+        self._xml_manifests = []
+        self._report = None
 
         self._default_revision = None
         self._default_remote = None
@@ -606,19 +1839,102 @@ class AospRepoTool:
 
     def addTrackRemote(self, path):
         if path:
-            self._list_track_remote.append(path)
+            with self._lock:
+                self._list_track_remote.append(path)
 
     def addPatch(self, entry=None):
         if entry:
-            Found = None
-            for stored_entry in self._list_patch:
-                if stored_entry[0] == entry[0] and stored_entry[1] == entry[1]:
-                    Found = stored_entry
-                    break
-            if Found is None:
-                self._list_patch.append(entry)
-            else:
-                self.logger.error("#### Duplicate entry {} vs stored {} ####".format(entry, stored_entry))
+            with self._lock:
+                Found = None
+                for stored_entry in self._list_patch:
+                    if stored_entry[0] == entry[0] and stored_entry[1] == entry[1]:
+                        Found = stored_entry
+                        break
+                if Found is None:
+                    self._list_patch.append(entry)
+            if Found is not None:
+                self.logger.error("#### Duplicate entry {} vs stored {} ####".format(entry, Found))
+
+    def addLargeBinaries(self, project, patch_filename, patch_size, binaries):
+        with self._lock:
+            self._list_large_binaries.append({'path': project.path, 'patch': patch_filename,
+                                              'patch_bytes': patch_size, 'binaries': binaries})
+
+    def sortResults(self):
+        """
+        Restores manifest order of patches, tracked projects and large binaries recorded by concurrent processing, for
+        generated files to be stable
+        :return:
+        """
+        order = {projet.path: idx for idx, projet in enumerate(self._list_projects)}
+        self._list_patch.sort(key=lambda entry: order.get(entry[0].path, len(order)))
+        self._list_track_remote.sort(key=lambda path: order.get(path, len(order)))
+        self._list_large_binaries.sort(key=lambda entry: order.get(entry['path'], len(order)))
+
+    def applyPatchCommand(self, file_path, project):
+        """
+        Shell command applying a patch file of the delivery, decompressing it on the fly if needed. Squashed diffs
+        are applied to index and committed at once
+        :param file_path: Patch file path in generated script
+        :param project: AospProject of the patch
+        :return: Command string
+        """
+        # Type is given by suffixes, file path being possibly shell quoted
+        name = file_path.rstrip("'")
+        decompress = None
+        for compress, command, suffix in COMPRESSORS.values():
+            if name.endswith(suffix):
+                decompress = command
+                name = name[:-len(suffix)]
+
+        if name.endswith('.diff'):
+            message = "{}: {} {}..{}".format(self._args['product_tag'], project.path, project.s_commit_co,
+                                             project.s_commit_courant)
+            if decompress:
+                return "{} {} | git apply --index && git commit -q -m {}".format(decompress, file_path,
+                                                                                shlex.quote(message))
+            return "git apply --index {} && git commit -q -m {}".format(file_path, shlex.quote(message))
+
+        if decompress:
+            return "{} {} | git am -3 -k --ignore-whitespace".format(decompress, file_path)
+        return "git am -3 -k --ignore-whitespace {}".format(file_path)
+
+    def writeBinariesInstructions(self, f_out, project):
+        """
+        Writes instructions restoring large binaries delivered out of the patch of a project
+        :param f_out: Generated script file
+        :param project: AospProject to handle
+        :return:
+        """
+        if project.binaries_archive or project.binaries_removed:
+            archive = None
+            if project.binaries_archive:
+                self.writeChecksumInstructions(f_out, project.binaries_archive)
+                archive = "$PATCH_HOME/{}".format(project.binaries_archive)
+            f_out.write("{}\n".format(self.binariesCommand(project, archive, "$AOSP_BASE/{}".format(project.path))))
+            f_out.write("if [ $? -ne 0 ]; then\n"
+                        "  echo \"Erreur pour le repo {}: application des binaires\"\n"
+                        "  exit 1\n"
+                        "fi\n".format(project.path))
+
+    def binariesCommand(self, project, archive, folder):
+        """
+        Builds the command committing large binaries of a project delivered out of its patch: extraction of the archive
+        and removal of binaries deleted in delivered version
+        :param project: AospProject to handle
+        :param archive: Archive path as seen by the command, None without archive
+        :param folder: Project folder as seen by the command, command being run from it
+        :return: Shell command
+        """
+        commands = []
+        if archive:
+            commands.append("tar -xzf {} -C {}".format(archive, folder))
+        if project.binaries_removed:
+            commands.append("git rm -q --ignore-unmatch -- {}".format(
+                " ".join([shlex.quote(path) for path in project.binaries_removed])))
+        commands.append("git add -A")
+        commands.append("git commit -q -m \"{}: large binaries of {}\"".format(self._args['product_tag'], project.path))
+        return " && ".join(commands)
 
     def updateRemainingGitFolders(self, path=""):
         """
@@ -626,8 +1942,8 @@ class AospRepoTool:
         :param path: Path of the project
         :return: None, exits if needed
         """
-        if path in self._list_remaining_git_folders:
-            self._list_remaining_git_folders.remove(path)
+        self._manifest_paths.add(path)
+        if self._list_remaining_git_folders.pop(path, False) is None:
             self.logger.debug("Removing {} from unhandled git projects "
                               "({} left)".format(path, len(self._list_remaining_git_folders)))
 
@@ -658,9 +1974,10 @@ class AospRepoTool:
                     break
         return proj_revision
 
-    def initArgParser(self):
+    def initArgParser(self, argv=None):
         """
         This method initialises the argument parser for this tool
+        :param argv: Arguments to parse instead of command line ones
         :return:
         """
         description = """AospRepoTool.py is a tool for producing AOSP patch delivery from an original 'repo' source tree
@@ -670,6 +1987,19 @@ Run \'./AospRepoTool.py -h\' for more information"""
         self._parser = ArgumentParser(description=description)
         self._parser.add_argument('-a', '--aosp', help="Path to top dir of AOSP source tree",
                                   dest="aosp", default='.')
+        self._parser.add_argument("-ac", "--archive_cache", help="Folder of archives shared between deliveries, unchanged "
+                                                                 "projects being reused instead of archived again",
+                                  dest='archive_cache', default=None)
+        self._parser.add_argument("-ba", "--bare", help="Analyse projects in their object stores (.repo/projects, "
+                                                        ".repo/project-objects or mirror) without working trees, "
+                                                        "delivered commit being --to_tag or object store HEAD",
+                                  dest='bare', action="store_true", default=False)
+        self._parser.add_argument("-b", "--batch", help="Json file listing several deliveries (since_tag, to_tag, product, "
+                                                        "product_tag, output_folder) produced from a single analysis",
+                                  dest='batch', default=None)
+        self._parser.add_argument("-cg", "--commit_graph", help="Build or refresh git commit-graph files of all projects "
+                                                                "before analysis",
+                                  dest='commit_graph', action="store_true", default=False)
         self._parser.add_argument('-d', '--debug', help="Activates debug traces",
                                   dest='debug', action="store_true", default=False)
         self._parser.add_argument("-f", "--fetch", help="Fetching tags before processing",
@@ -677,7 +2007,11 @@ Run \'./AospRepoTool.py -h\' for more information"""
         self._parser.add_argument("-df", "--diff_format", help="Production of patchs in subfolders organised similarily "
                                                                "to original source tree, one patch per commit",
                                   dest='diff_format', action="store_true", default=False)
-        self._parser.add_argument("-i", "--inspect_repo", help="Dry run",
+        self._parser.add_argument("-g", "--groups", help="Restrict delivery to projects matching manifest groups, "
+                                                         "repo tool syntax (e.g. 'default,-notdefault,vendor')",
+                                  dest='groups', default=None)
+        self._parser.add_argument("-i", "--inspect_repo", help="Dry run: fast classification of projects against "
+                                                               "manifest using local refs only",
                                   dest="inspect_repo", action="store_true", default=False)
         self._parser.add_argument("-id", "--ignore_dirty", help="Ignores untracked and checked in files in projects",
                                   dest="ignore_dirty", action="store_true", default=False)
@@ -689,12 +2023,37 @@ Run \'./AospRepoTool.py -h\' for more information"""
                                   dest="jobs", default=4)
         self._parser.add_argument("-m", "--manifests", help="Specific path for \'.repo' folder",
                                   dest="manifests", default=None)
+        self._parser.add_argument("-lb", "--large_binaries_archive", help="Move large binaries of patches exceeding "
+                                                                          "--max_patch_size to a separate archive",
+                                  dest="large_binaries_archive", action="store_true", default=False)
+        self._parser.add_argument("-lbs", "--large_binary_size", help="Size in MB from which a binary change is "
+                                                                      "reported as large",
+                                  dest="large_binary_size", default=1)
+        self._parser.add_argument("-md", "--max_depth", help="Maximum number of commits walked in each history when "
+                                                             "searching a divergence point (0: unlimited)",
+                                  dest="max_depth", default=0)
+        self._parser.add_argument("-mm", "--max_memory", help="Memory budget in MB for divergence point search "
+                                                              "(0: unlimited)",
+                                  dest="max_memory", default=0)
+        self._parser.add_argument("-mps", "--max_patch_size", help="Patch size in MB above which large binary changes "
+                                                                   "are reported (0: unlimited)",
+                                  dest="max_patch_size", default=0)
+        self._parser.add_argument("-mi", "--multi_pack_index", help="Also write multi-pack-index files when preparing "
+                                                                    "commit-graphs",
+                                  dest="multi_pack_index", action="store_true", default=False)
+        self._parser.add_argument("-nc", "--no_ref_cache", help="Do not keep resolved tags in .repo for next runs",
+                                  dest="no_ref_cache", action="store_true", default=False)
         self._parser.add_argument("-nr", "--no_rebase", help="Inhibits rebasing instruction generation in patch script",
                                   dest="no_rebase", action="store_true", default=False)
-        self._parser.add_argument("-s", "--scope_projects", help="Explicit list of project to handle in delivery. "
-                                                                 "Keep empty for full processing",
+        self._parser.add_argument("-rp", "--report", help="Write a json report with per project commits, sizes and "
+                                                          "timings in output folder",
+                                  dest="report", action="store_true", default=False)
+        self._parser.add_argument("-s", "--scope_projects", help="Explicit list of project paths, globs or 're:' regular "
+                                                                 "expressions to handle in delivery. Keep empty for "
+                                                                 "full processing",
                                   dest="scope_projects", nargs='+', default=[])
-        self._parser.add_argument("-sp", "--skip_projects", help="List of project's name to filter out from delivery.",
+        self._parser.add_argument("-sp", "--skip_projects", help="List of project paths, globs or 're:' regular "
+                                                                 "expressions to filter out from delivery.",
                                   dest="skip_projects", nargs='+', default=[])
         self._parser.add_argument("-st", "--since_tag", help="Start patch production since alternative tags instead of"
                                                              " manifest revision if found",
@@ -710,16 +2069,48 @@ Run \'./AospRepoTool.py -h\' for more information"""
         self._parser.add_argument("-p", "--product", help="Name of terminal",                                 dest="product", default="product")
         self._parser.add_argument("-pt", "--product_tag", help="Delivery tag",
                                   dest="product_tag", default="XX_XY_V1.0")
+        self._parser.add_argument("-pl", "--pipeline", help="Stream delivery: analyse projects as soon as they are parsed "
+                                                            "and build archives while analysis goes on",
+                                  dest="pipeline", action="store_true", default=False)
+        self._parser.add_argument("-pm", "--pinned_manifest", help="Write a manifest pinning each project to its "
+                                                                   "delivered commit for a fast 'repo sync'",
+                                  dest="pinned_manifest", action="store_true", default=False)
+        self._parser.add_argument("-pf", "--preflight", help="Check every project (clean state, manifest revision, tags, "
+                                                             "shallow history, remote) before processing and report "
+                                                             "all problems at once",
+                                  dest="preflight", action="store_true", default=False)
         self._parser.add_argument("-q", "--quiet", help="Silent execution",
                                   dest="quiet", action="store_true", default=False)
+        self._parser.add_argument("-sq", "--squash", help="Deliver each project as a single binary diff applied and "
+                                                         "committed at once, without commits history",
+                                  dest="squash", action="store_true", default=False)
         self._parser.add_argument("-t", "--tar", help="Produce tar.gz of modified projects",
                                   dest="tar", action="store_true", default=False,)
         self._parser.add_argument("-tr", "--track_remote", help="Output all git repos which use this remote name for "
                                                                 "fetching",
                                   dest="track_remote", nargs='+', default=[])
-        self._parser.add_argument("-u", "--unshallow", help="Add unshalloing instruction in generated script if needed",
+        self._parser.add_argument("-vd", "--verify_delivery", help="Check that delivered patches apply on checkout "
+                                                                   "commits in scratch worktrees",
+                                  dest="verify_delivery", action="store_true", default=False)
+        self._parser.add_argument("-w", "--watch", help="Keep running and update delivery when projects change",
+                                  dest="watch", action="store_true", default=False)
+        self._parser.add_argument("-wi", "--watch_interval", help="Polling period in seconds of watch mode",
+                                  dest="watch_interval", default=2.0)
+        self._parser.add_argument("-ws", "--watch_socket", help="Unix socket receiving requests in watch mode",
+                                  dest="watch_socket", default=None)
+        self._parser.add_argument("-wc", "--watch_command", help="Send a request (deliver, status, stop) to a running "
+                                                                 "watcher through --watch_socket and exit",
+                                  dest="watch_command", choices=['deliver', 'status', 'stop'], default=None)
+        self._parser.add_argument("-z", "--compress", help="Compress patch files, generated scripts decompressing them on "
+                                                           "the fly",
+                                  dest="compress", choices=list(COMPRESSORS.keys()), default=None)
+        self._parser.add_argument("-u", "--unshallow", help="Deepen shallow histories as needed during analysis and add "
+                                                            "deepening instructions in generated script",
                                   dest="unshallow", action="store_true", default=False)
-        self._args = vars(self._parser.parse_args())
+        self._parser.add_argument("-ds", "--deepen_step", help="Initial number of commits fetched when deepening a "
+                                                               "shallow history, doubled at each attempt",
+                                  dest="deepen_step", default=50)
+        self._args = vars(self._parser.parse_args(argv))
 
     def processArgs(self):
         """
@@ -739,28 +2130,91 @@ Run \'./AospRepoTool.py -h\' for more information"""
             if self._args['manifests'] == '.':
                 self._args['manifests'] = abspath('.')
 
+        # Patches are produced from projects folders, output folder must not be relative
         self._args['output_folder'] = expanduser(self._args['output_folder'])
-        if self._args['output_folder'] == '.':
-            self._args['output_folder'] = abspath('.')
+        if self._args['output_folder']:
+            self._args['output_folder'] = abspath(self._args['output_folder'])
 
         if not exists(self._args['aosp']) or not exists(self._args['manifests']) or not self._args['output_folder']:
-            self._parser.print_usage()
-            exit(1)
+            if self._parser:
+                self._parser.print_usage()
+            raise AospRepoToolError("Invalid AOSP, manifests or output folder path", 1)
 
         if not isdir(self._args['aosp']):
             self.logger.error("Check your AOSP path: {}".format(self._args['aosp']))
-            self._parser.print_usage()
-            exit(2)
+            if self._parser:
+                self._parser.print_usage()
+            raise AospRepoToolError("AOSP path is not a folder: {}".format(self._args['aosp']), 2)
 
-        if not exists(self._args['output_folder']):
+        # Inspection writes nothing, output folder is only created for deliveries
+        if not self._args['inspect_repo'] and not exists(self._args['output_folder']):
             makedirs(self._args['output_folder'])
 
+        if self._args['archive_cache']:
+            self._args['archive_cache'] = abspath(expanduser(self._args['archive_cache']))
+            makedirs(self._args['archive_cache'], exist_ok=True)
+
+        # Project selection is compiled once, then evaluated for each manifest entry before any git access
+        self._scope_selection = self.compileSelection(self._args['scope_projects'])
+        self._skip_selection = self.compileSelection(self._args['skip_projects'])
+        if self._args['groups']:
+            self._groups = [group for group in re.split(r'[,\s]+', self._args['groups']) if group]
+
+        if self._ref_cache is None:
+            self._ref_cache = self.openRefCache()
+
+        if self._args['squash'] and self._args['diff_format']:
+            self.logger.warning("! Squashed deliveries are single diffs, --squash ignored with --diff_format")
+            self._args['squash'] = False
+
+        if self._args['large_binaries_archive'] and self._args['diff_format']:
+            self.logger.warning("! Per-commit patches are not rerouted, --large_binaries_archive ignored with "
+                                "--diff_format")
+            self._args['large_binaries_archive'] = False
+
+        if self._args['bare']:
+            if self._args['tar']:
+                self.logger.warning("! Archives need working trees, --tar ignored in bare mode")
+                self._args['tar'] = False
+            if not self._args['to_tag']:
+                self.logger.info("Bare mode without --to_tag: delivered commits are object stores HEAD")
+
+    def openRefCache(self):
+        """
+        Opens the cache of resolved refs in .repo folder, limited to this run if disabled, not writable or when
+        inspecting, which writes nothing in the tree
+        :return: RefCache
+        """
+        repo_dir = join(self._args['aosp'], '.repo')
+        if (not self._args['no_ref_cache'] and not self._args['inspect_repo'] and isdir(repo_dir) and
+                os.access(repo_dir, os.W_OK)):
+            try:
+                return RefCache(join(repo_dir, REF_CACHE_NAME), self.logger)
+            except sqlite3.Error as e:
+                self.logger.warning("! Unable to open ref cache in {}: {}".format(repo_dir, str(e)))
+        return RefCache(None, self.logger)
+
     def parseManifests(self):
         """
         This method reads and stores usefull manifest in the indicated manifest folder
         :return: void
         """
+        self.listManifests()
+
+        # Inspection does not report projects out of manifests, object stores have no working tree to walk
+        if self._args['inspect_repo'] or self._args['bare']:
+            return
+
+        self._list_remaining_git_folders = OrderedDict.fromkeys(self.discoverGitFolders())
+        self.logger.debug("Full list of git projects:\n{}".format(len(self._list_remaining_git_folders)))
+
+    def listManifests(self):
+        """
+        Builds the list of manifests to handle
+        :return: void
+        """
         # Build a list of manifests to handle
+        self._list_manifests = []
         if isfile(self._args['manifests']):
             # The only manifest to handle is the one indicated in argument
             self._list_manifests = [self._args['manifests']]
@@ -768,14 +2222,20 @@ Run \'./AospRepoTool.py -h\' for more information"""
             for root, dirs, files in walk(self._args['manifests']):
                 for f_name in files:
                     if '.xml' in f_name:
-                        if not islink(f_name):
+                        if not islink(join(root, f_name)):
                             # Add this xml manifest for later handling
-                            logger.info("+ Adding file {} to the processing xml to handle".format(f_name))
+                            self.logger.info("+ Adding file {} to the processing xml to handle".format(f_name))
                             self._list_manifests.append(root + '/' + f_name)
                         else:
-                            logger.debug("! {} is symlink => Ignored".format(f_name))
+                            self.logger.debug("! {} is symlink => Ignored".format(f_name))
 
+    def discoverGitFolders(self):
+        """
+        Walks AOSP tree looking for git working trees
+        :return: List of git folders paths relative to AOSP top dir
+        """
         # Build a list of folder under git management
+        git_folders = []
         for root, dirs, files in walk(self._args['aosp']):
             if '.git' in root:
                 continue
@@ -783,22 +2243,24 @@ Run \'./AospRepoTool.py -h\' for more information"""
                 continue
             if '.git' in dirs:
                 # Adding parent folder in the list of git repositories
-                self._list_remaining_git_folders.append(root.replace(self._args['aosp'] + '/', ''))
-        logger.debug("Full list of git projects:\n{}".format(len(self._list_remaining_git_folders)))
+                git_folders.append(root.replace(self._args['aosp'] + '/', ''))
+        return git_folders
 
-    def processManifests(self):
+    def processManifests(self, callback=None):
         """
         Simple method to process all manifest file as provided by program arguments
+        :param callback: Optional callable receiving each new project, which is then left unprepared
         :return:
         """
         for manifest in self._list_manifests:
-            self.processManifest(manifest)
+            self.processManifest(manifest, callback)
 
-    def processManifest(self, manifest):
+    def processManifest(self, manifest, callback=None):
         """
         Analysis of project indicated by manifests and produces a patch when current commit is not the one indicated
         by manifest revision
         :param manifest: Manifest to handle
+        :param callback: Optional callable receiving each new project, which is then left unprepared
         :return:
         """
         basename = manifest.split('/')[-1].split('.')[0]
@@ -807,6 +2269,7 @@ Run \'./AospRepoTool.py -h\' for more information"""
         with open(manifest, 'r') as xml_input:
             xml = xml_input.read()
             xml_manifest = xmltodict.parse(xml)
+        self._xml_manifests.append(xml_manifest)
 
         revision = None
         remote = None
@@ -829,7 +2292,6 @@ Run \'./AospRepoTool.py -h\' for more information"""
                     remote_name = remote['@name']
                     self.logger.warning(
                         "! Several remote exists for this manifest!! => Selection of {}".format(remote))
-                    pdb.set_trace()
                 else:
                     remote = xml_manifest['manifest']['remote']
                     remote_name = remote['@name']
@@ -843,17 +2305,25 @@ Run \'./AospRepoTool.py -h\' for more information"""
             if 'project' in xml_manifest['manifest']:
                 if not isinstance(xml_manifest['manifest']['project'], list):
                     xml_manifest['manifest']['project'] = [xml_manifest['manifest']['project']]
+                progress = ProgressReporter(self.logger, "Parsing {}".format(basename),
+                                            len(xml_manifest['manifest']['project']))
                 for projet_xml in xml_manifest['manifest']['project']:
-                    projet_obj = self.parseXmlProject(projet_xml, basename, default_revision, remote_name)
+                    projet_obj = self.parseXmlProject(projet_xml, basename, default_revision, remote_name,
+                                                      prepare=callback is None)
                     if projet_obj and projet_obj not in self._list_projects:
                         self._list_projects.append(projet_obj)
+                        if callback:
+                            callback(projet_obj)
+                    progress.update()
+                progress.finish()
 
-    def parseXmlProject(self, projet_xml, basename, default_revision, default_remote):
+    def parseXmlProject(self, projet_xml, basename, default_revision, default_remote, prepare=True):
         """
         This method initialise AospProject object based on project xml description
         :param projet_xml: XML description of current project
         :param basename: xml file basename
         :param default_revision: default revision for current manifest
+        :param prepare: Prepare project for delivery, unless preflight is requested
         :return:
         """
         # Use default config for since tag and to tag
@@ -870,15 +2340,24 @@ Run \'./AospRepoTool.py -h\' for more information"""
         # Update remaining git projects list
         self.updateRemainingGitFolders(path)
 
+        # A path listed by several manifests is handled once, projects being processed concurrently
+        if path in self._project_paths:
+            self.logger.info("! Ignoring project {} already listed by a manifest".format(path))
+            return None
+
         # Filter out unneeded projects
-        if path in self._args['skip_projects']:
+        if self.matchesSelection(self._skip_selection, path):
             self.logger.info("! Ignoring explicitly skipped project {}".format(path))
             return None
 
-        if self._args['scope_projects'] and path not in self._args['scope_projects']:
+        if self._args['scope_projects'] and not self.matchesSelection(self._scope_selection, path):
             self.logger.info("! Ignoring out of scope project {}".format(path))
             return None
 
+        if self._groups and not self.matchesGroups(projet_xml, path):
+            self.logger.info("! Ignoring project {} out of groups {}".format(path, self._args['groups']))
+            return None
+
         # Retrieve active remote for this project
         if '@remote' in projet_xml:
             remote = projet_xml['@remote']
@@ -886,25 +2365,175 @@ Run \'./AospRepoTool.py -h\' for more information"""
         # Select the active revision depending on xml content
         proj_revision = self.selectRevision(projet_xml)
 
-        # Creation of git repo object for futur queries
+        # Reading of git metadata for futur queries, git repo object being opened on demand
         try:
-            git_repo = git.Repo(self._args['aosp'] + '/' + path)
+            if self._args['bare']:
+                # Object stores do not tell if a project was removed from the tree
+                metadata = self.openObjectStore(path, projet_xml.get('@name', path))
+                if metadata is None:
+                    self.logger.error("! Object store not found for project {}, left out of delivery".format(path))
+                    return None
+            else:
+                metadata = GitMetadata(self._args['aosp'] + '/' + path)
         except git.exc.NoSuchPathError:
             self.logger.info("- Record project as removed {}".format(path))
             self._list_removed_projects.append(path)
             return None
         except Exception as e:
-            self.logger.error("!- Impossible to handle project {}: {}".format(path, str(e)))
-            exit(-1)
+            message = "!- Impossible to handle project {}: {}".format(path, str(e))
+            self.logger.error(message)
+            raise AospRepoToolError(message, -1)
+
+        project = AospProject(basename, path, metadata, remote, proj_revision, self._args, self.logger,
+                              self._ref_cache)
+        self._project_paths.add(path)
+        if prepare and (not self._args['preflight'] or self._args['inspect_repo']):
+            self.prepareProject(project)
+        return project
+
+    @staticmethod
+    def compileSelection(patterns):
+        """
+        Compiles a list of project selection patterns: exact paths, globs, or regular expressions prefixed by 're:'
+        :param patterns: List of patterns from command line
+        :return: Tuple of exact paths set and regular expression matching all other patterns, or None
+        :raise AospRepoToolError: on invalid regular expression
+        """
+        exact = set()
+        expressions = []
+        for pattern in patterns:
+            if pattern.startswith('re:'):
+                expressions.append('(?:{})\\Z'.format(pattern[3:]))
+            elif any(char in pattern for char in '*?['):
+                expressions.append(fnmatch.translate(pattern.rstrip('/')))
+            else:
+                exact.add(pattern.rstrip('/'))
+        try:
+            return exact, re.compile('|'.join(expressions)) if expressions else None
+        except re.error as e:
+            raise AospRepoToolError("Invalid project pattern in {}: {}".format(patterns, str(e)), 1)
 
-        project = AospProject(basename, path, git_repo, remote, proj_revision, self._args, self.logger)
-        if not project.isValid():
+    @staticmethod
+    def matchesSelection(selection, path):
+        """
+        Checks a project path against a compiled selection
+        :param selection: Tuple from compileSelection
+        :param path: Project path in manifest
+        :return: True if path is selected
+        """
+        exact, expression = selection
+        return path in exact or (expression is not None and expression.match(path) is not None)
+
+    def matchesGroups(self, projet_xml, path):
+        """
+        Checks manifest groups of a project against requested groups, as repo tool does: each project belongs to
+        'all', 'name:<name>', 'path:<path>', its 'groups' attribute and 'default' unless 'notdefault' is one of them.
+        Requested groups are evaluated in order, a '-' prefix excluding the project.
+        :param projet_xml: XML description of current project
+        :param path: Project path in manifest
+        :return: True if project is selected
+        """
+        project_groups = {'all', 'name:{}'.format(projet_xml.get('@name', path)), 'path:{}'.format(path)}
+        project_groups.update(group for group in re.split(r'[,\s]+', projet_xml.get('@groups', '')) if group)
+        if 'notdefault' not in project_groups:
+            project_groups.add('default')
+
+        matched = False
+        for group in self._groups:
+            if group.startswith('-') and group[1:] in project_groups:
+                matched = False
+            elif group in project_groups:
+                matched = True
+        return matched
+
+    def openObjectStore(self, path, name):
+        """
+        Opens the object store of a project without using its working tree, looking for repo tool layout
+        (.repo/projects/<path>.git, .repo/project-objects/<name>.git) then mirror layout (<name>.git)
+        :param path: Project path in manifest
+        :param name: Project name in manifest
+        :return: GitMetadata of the object store, None if no object store exists for this project
+        """
+        repo_dir = join(self._args['aosp'], '.repo')
+        for git_dir in [join(repo_dir, 'projects', path + '.git'), join(repo_dir, 'project-objects', name + '.git'),
+                        join(self._args['aosp'], name + '.git')]:
+            if isdir(git_dir):
+                self.logger.debug("+ Object store of {}: {}".format(path, git_dir))
+                return GitMetadata(git_dir)
+        return None
+
+    def prepareProject(self, project):
+        """
+        Extracts commits of interest of a project for the current delivery and sets its default checkout point
+        :param project: AospProject to prepare
+        :return:
+        """
+        if not project.isValid() and not self._args['inspect_repo']:
             project.exitIfCritical()
 
         # Record point of checkout to manifest revision if not yet defined
         if project.commit_co is None:
             project.setCommitCo(project.commit_manifest)
-        return project
+
+    def preflightProjects(self):
+        """
+        Checks concurrently every manifest project before any expensive phase, reporting all problems at once. Projects
+        are prepared for delivery once the whole tree passes
+        :return: Dictionary of (level, message) problems by project path
+        :raise AospRepoToolError: if a blocking problem is found
+        """
+        progress = ProgressReporter(self.logger, "Preflight", len(self._list_projects))
+
+        def check(projet):
+            try:
+                problems = projet.preflight()
+            except Exception as e:
+                problems = [(logging.ERROR, "unexpected error: {}".format(e))]
+            progress.update()
+            return problems
+
+        with ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as executor:
+            results = OrderedDict(zip([projet.path for projet in self._list_projects],
+                                      executor.map(check, self._list_projects)))
+        progress.finish()
+
+        results = OrderedDict([(path, problems) for path, problems in results.items() if problems])
+        errors = 0
+        warnings = 0
+        blocked = set()
+        for path, problems in results.items():
+            for level, message in problems:
+                self.logger.log(level, "! Preflight {}: {}".format(path, message))
+                if level >= logging.ERROR:
+                    errors += 1
+                    blocked.add(path)
+                else:
+                    warnings += 1
+        self.logger.info("Preflight of {} projects: {} blocking problems, {} warnings".format(len(self._list_projects),
+                                                                                             errors, warnings))
+        if errors:
+            raise AospRepoToolError("Preflight failed with {} blocking problems in {} projects".format(
+                errors, len(blocked)), 1)
+
+        for projet in self._list_projects:
+            self.prepareProject(projet)
+        return results
+
+    def prepareCommitGraphs(self):
+        """
+        Builds or refreshes commit-graph files of every manifest project in parallel before analysis. Object stores
+        shared by several projects are handled once and up to date ones are skipped
+        :return:
+        """
+        stores = {}
+        for projet in self._list_projects:
+            stores.setdefault(projet.objectsDir(), projet)
+
+        self.logger.info("Preparing commit-graphs of {} object stores".format(len(stores)))
+        with ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as executor:
+            written = list(executor.map(lambda p: p.writeCommitGraph(self._args['multi_pack_index']),
+                                        stores.values()))
+        self.logger.info("Commit-graphs refreshed in {}/{} object stores".format(written.count(True), len(stores)))
 
     def processProjects(self):
         """
@@ -916,8 +2545,408 @@ Run \'./AospRepoTool.py -h\' for more information"""
         # On produit un patch pour ce projet qu'on va concaténer au fichier global pour ce manifest
 
         # Récupération du chemin pour faire les interrogations avec git
-        for projet in self._list_projects:
+        self.openReport()
+        timings = self.loadTimings()
+        schedule = self.scheduleProjects(timings)
+        progress = ProgressReporter(self.logger, "Processing projects", len(self._list_projects))
+
+        def process(projet):
+            start = time.time()
+            projet.process(self)
+            duration = time.time() - start
+            if self._report:
+                self._report.add(projet.reportEntry(duration))
+            progress.update(1, projet.patch_bytes)
+            return duration
+
+        # Longest projects are submitted first for workers to stay busy until the end
+        with ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as executor:
+            futures = [(projet, commits, executor.submit(process, projet)) for estimate, commits, projet in schedule]
+            try:
+                for projet, commits, future in futures:
+                    timing = timings.setdefault(projet.path, {})
+                    timing['duration'] = round(future.result(), 3)
+                    if commits is not None:
+                        timing['commits'] = commits
+            except Exception:
+                for projet, commits, future in futures:
+                    future.cancel()
+                raise
+        progress.finish()
+
+        self.sortResults()
+        self.saveTimings(timings)
+
+    def pipelined(self):
+        """
+        Check if delivery can be streamed, preflight, inspection, batch and watch modes needing every project first
+        :return: True if pipeline option applies
+        """
+        if not self._args['pipeline']:
+            return False
+        for option in ['preflight', 'inspect_repo', 'batch', 'watch']:
+            if self._args[option]:
+                self.logger.info("Pipeline not available with {} option, running phase after phase".format(option))
+                return False
+        return True
+
+    def processPipeline(self):
+        """
+        Streaming delivery: the tree walk runs in background, each project is analysed and patched as soon as it is
+        parsed, and archives are built in a separate pool while analysis goes on. Scripts are then written in
+        manifest order as in phased processing
+        :return:
+        """
+        self.listManifests()
+        timings = self.loadTimings()
+        progress = ProgressReporter(self.logger, "Processing projects")
+        stores = set()
+        archives = []
+        arch_names = []
+
+        def archive(path, arch_name):
+            arch_names.append(arch_name)
+            return archiver.submit(self.produceArchive, path, arch_name)
+
+        def analyse(projet):
+            start = time.time()
+            if self._args['commit_graph']:
+                with self._lock:
+                    store = projet.objectsDir()
+                    first = store not in stores
+                    stores.add(store)
+                if first:
+                    projet.writeCommitGraph(self._args['multi_pack_index'])
+            self.prepareProject(projet)
             projet.process(self)
+            duration = time.time() - start
+            timings.setdefault(projet.path, {})['duration'] = round(duration, 3)
+            if self._report:
+                self._report.add(projet.reportEntry(duration))
+            progress.update(1, projet.patch_bytes)
+
+            # Archives of delivered projects are built while other projects are analysed
+            if self._args['tar'] and [entry for entry in self._list_patch if entry[0] == projet]:
+                makedirs(join(self._args['output_folder'], 'archive'), exist_ok=True)
+                archives.append(archive(projet.path, join('archive', projet.path.replace('/', '_') + ".tar.gz")))
+
+        self.openReport()
+        try:
+            with ThreadPoolExecutor(max_workers=1) as walker, \
+                    ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as archiver, \
+                    ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as analyser:
+                walk_future = None
+                if not self._args['bare']:
+                    walk_future = walker.submit(self.discoverGitFolders)
+                futures = []
+                self.processManifests(callback=lambda projet: futures.append(analyser.submit(analyse, projet)))
+
+                # Projects out of manifests are known once tree is walked and manifests are parsed
+                if walk_future:
+                    self._list_remaining_git_folders = OrderedDict.fromkeys(path for path in walk_future.result()
+                                                                            if path not in self._manifest_paths)
+                    for path in self._list_remaining_git_folders:
+                        archives.append(archive(path, path.replace('/', '_') + ".tar.gz"))
+
+                try:
+                    for future in futures:
+                        future.result()
+                except Exception:
+                    for future in futures + archives:
+                        future.cancel()
+                    raise
+                progress.finish()
+                for future in list(archives):
+                    future.result()
+
+            # Archives already built are not produced again with delivery scripts
+            self._pipeline_archives = set(arch_names)
+            self.sortResults()
+            self.saveTimings(timings)
+            self.processDelivery()
+        finally:
+            self.closeReport()
+
+    def loadTimings(self):
+        """
+        Reads project durations recorded by previous runs in output folder
+        :return: Dictionary of {'duration': seconds, 'commits': count} by project path
+        """
+        try:
+            with open(join(self._args['output_folder'], 'project_timings.json'), 'r') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def saveTimings(self, timings):
+        """
+        Records project durations in output folder for later runs scheduling
+        :param timings: Dictionary of {'duration': seconds, 'commits': count} by project path
+        :return:
+        """
+        with open(join(self._args['output_folder'], 'project_timings.json'), 'w') as fd:
+            json.dump(timings, fd, indent=2, sort_keys=True)
+
+    def scheduleProjects(self, timings):
+        """
+        Orders projects longest first. Durations of previous runs are used when known, other projects being estimated
+        from their pending commits and the average duration per commit of previous runs
+        :param timings: Dictionary of {'duration': seconds, 'commits': count} by project path
+        :return: List of (estimated duration, pending commits or None, AospProject) by decreasing estimate
+        """
+        unknown = [projet for projet in self._list_projects if projet.path not in timings]
+        with ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as executor:
+            commits = dict(zip(unknown, executor.map(lambda projet: projet.pendingCommits(), unknown)))
+
+        known = [timing for timing in timings.values() if timing.get('commits')]
+        per_commit = 1.0
+        if known:
+            per_commit = sum([timing['duration'] for timing in known]) / sum([timing['commits'] for timing in known])
+
+        schedule = []
+        for projet in self._list_projects:
+            if projet in commits:
+                schedule.append((commits[projet] * per_commit, commits[projet], projet))
+            else:
+                schedule.append((timings[projet.path].get('duration', 0), None, projet))
+        schedule.sort(key=lambda item: item[0], reverse=True)
+        self.logger.debug("Projects schedule: {}".format([(projet.path, round(estimate, 3))
+                                                          for estimate, _, projet in schedule]))
+        return schedule
+
+    def openReport(self):
+        """
+        Starts the delivery report of the current delivery if requested
+        :return:
+        """
+        if self._args['report'] and self._report is None:
+            self._report = DeliveryReport(join(self._args['output_folder'], 'delivery_report.json'))
+
+    def closeReport(self):
+        """
+        Completes the delivery report of the current delivery if any
+        :return:
+        """
+        if self._report:
+            self._report.close()
+            self.logger.info("Delivery report written in {}".format(self._report.file_name))
+            self._report = None
+
+    def inspectProjects(self):
+        """
+        Fast inspection: classifies concurrently every project against its manifest revision and prints a summary
+        table, without fetching, writing or walking histories
+        :return: Dictionary of project path by state
+        """
+        def classify(projet):
+            try:
+                return projet.inspect()
+            except Exception as e:
+                self.logger.error("Impossible to inspect {}: {}".format(projet.path, e))
+                return 'error'
+
+        with ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as executor:
+            states = list(executor.map(classify, self._list_projects))
+
+        width = max([len(path) for path in self._list_removed_projects] +
+                    [len(projet.path) for projet in self._list_projects] + [len('PROJECT')])
+        print("{:<{w}}  {:<16}  {:<9}  {:<9}".format('PROJECT', 'STATE', 'HEAD', 'MANIFEST', w=width))
+        summary = {}
+        for projet, state in zip(self._list_projects, states):
+            summary.setdefault(state, []).append(projet.path)
+            print("{:<{w}}  {:<16}  {:<9}  {:<9}".format(projet.path, state, projet.s_commit_courant,
+                                                         projet.s_commit_manifest, w=width))
+        for path in self._list_removed_projects:
+            print("{:<{w}}  {:<16}".format(path, 'removed', w=width))
+        print("\n" + ", ".join(["{}: {}".format(state, len(paths)) for state, paths in sorted(summary.items())]))
+        return summary
+
+    def loadBatch(self, batch_file):
+        """
+        Reads a batch description: a json list of deliveries, each one being a dictionary with since_tag, to_tag,
+        product, product_tag and optional output_folder keys
+        :param batch_file: Path to json file
+        :return: List of delivery specifications
+        """
+        with open(batch_file, 'r') as fd:
+            specs = json.load(fd)
+        if not isinstance(specs, list):
+            raise Exception("Batch file {} must contain a list of deliveries".format(batch_file))
+        return specs
+
+    def resetDelivery(self):
+        """
+        Forgets results of previous delivery, keeping parsed manifests and projects
+        :return:
+        """
+        self._list_patch = []
+        self._list_track_remote = []
+        self._list_archives = []
+        self._list_large_binaries = []
+
+    def updateProjects(self, projects):
+        """
+        Incremental delivery update: forgets results of the given projects, processes them again and regenerates
+        delivery scripts, other projects results being kept. A project failing to process is left out of regenerated
+        scripts
+        :param projects: List of changed AospProject
+        :return: List of AospProject which failed to process
+        """
+        paths = [projet.path for projet in projects]
+        for projet, filename, need_patch in [entry for entry in self._list_patch if entry[0] in projects]:
+            if projet.binaries_archive and isfile(join(self._args['output_folder'], projet.binaries_archive)):
+                os.unlink(join(self._args['output_folder'], projet.binaries_archive))
+            if filename:
+                for file_name in [join(self._args['output_folder'], filename),
+                                  join(self._args['output_folder'], projet.path, filename)]:
+                    if isfile(file_name):
+                        os.unlink(file_name)
+        for path in paths:
+            arch_name = join(self._args['output_folder'], 'archive', path.replace('/', '_') + ".tar.gz")
+            if exists(arch_name):
+                os.unlink(arch_name)
+        self._list_patch = [entry for entry in self._list_patch if entry[0] not in projects]
+        self._list_track_remote = [path for path in self._list_track_remote if path not in paths]
+        self._list_large_binaries = [entry for entry in self._list_large_binaries if entry['path'] not in paths]
+        self._list_archives = []
+
+        failed = []
+        try:
+            for projet in projects:
+                self.logger.info("Updating {}".format(projet.path))
+                try:
+                    projet.refresh()
+                    self.prepareProject(projet)
+                    projet.process(self)
+                except Exception as e:
+                    self.logger.error("! Update of {} failed: {}".format(projet.path, e))
+                    failed.append(projet)
+        finally:
+            # Scripts must not refer to deleted patches whatever happened
+            self.sortResults()
+            self.processDelivery()
+        return failed
+
+    def processBatch(self, specs):
+        """
+        Produces several deliveries from a single manifests and projects analysis. Manifest parsing, repositories,
+        dirty checks and revision and tag resolutions are shared, each delivery being written in its own folder
+        :param specs: List of delivery specifications (see loadBatch)
+        :return: List of DeliveryResult
+        """
+        return [self.deliver(spec) for spec in specs]
+
+    @contextmanager
+    def collectErrors(self):
+        """
+        Context keeping logged errors for structured results
+        :return:
+        """
+        handler = ErrorCollector(self._errors)
+        self.logger.addHandler(handler)
+        try:
+            yield
+        finally:
+            self.logger.removeHandler(handler)
+
+    def analyse(self):
+        """
+        Library entry point for shared analysis: normalises options, parses manifests and opens projects, once
+        :return: List of AospProject
+        :raise AospRepoToolError: on critical error
+        """
+        if not self._analysed:
+            with self.collectErrors():
+                self.processArgs()
+                self.parseManifests()
+                self.processManifests()
+                if self._args['preflight'] and not self._args['inspect_repo']:
+                    self.preflightProjects()
+                if self._args['commit_graph']:
+                    self.prepareCommitGraphs()
+            self._analysed = True
+        return self._list_projects
+
+    def deliver(self, spec=None):
+        """
+        Library entry point producing one delivery from analysed projects, which can be called several times on a
+        warm tool
+        :param spec: Optional dictionary overloading options listed in BATCH_KEYS for this delivery only, output
+         folder defaulting to <output_folder>/<product>_<product_tag>
+        :return: DeliveryResult
+        :raise AospRepoToolError: on critical error
+        """
+        self.analyse()
+        base = {key: self._args[key] for key in BATCH_KEYS}
+        self._errors = []
+        try:
+            with self.collectErrors():
+                if spec:
+                    self._args.update({key: spec[key] for key in BATCH_KEYS if key in spec})
+                    if 'output_folder' not in spec:
+                        self._args['output_folder'] = join(base['output_folder'], '{}_{}'.format(
+                            self._args['product'], self._args['product_tag']))
+                    self._args['output_folder'] = abspath(expanduser(self._args['output_folder']))
+                    makedirs(self._args['output_folder'], exist_ok=True)
+                    self.logger.info("Batch delivery {} {} ({}..{}) in {}".format(self._args['product'],
+                                                                                 self._args['product_tag'],
+                                                                                 self._args['since_tag'],
+                                                                                 self._args['to_tag'],
+                                                                                 self._args['output_folder']))
+                if spec or self._delivered:
+                    self.resetDelivery()
+                    for projet in self._list_projects:
+                        projet.resetDelivery()
+                        self.prepareProject(projet)
+                self.processProjects()
+                self.processDelivery()
+                self._delivered = True
+                return self.result()
+        finally:
+            self.closeReport()
+            self._args.update(base)
+
+    def run(self):
+        """
+        Library entry point running every phase according to options
+        :return: DeliveryResult, list of DeliveryResult with batch option, dictionary of project paths by state with
+         inspect_repo option
+        :raise AospRepoToolError: on critical error
+        """
+        if not self._analysed and self.pipelined():
+            self._errors = []
+            with self.collectErrors():
+                self.processArgs()
+                self.processPipeline()
+            self._analysed = True
+            self._delivered = True
+            return self.result()
+        self.analyse()
+        if self._args['inspect_repo']:
+            return self.inspectProjects()
+        if self._args['batch']:
+            specs = self._args['batch']
+            if not isinstance(specs, list):
+                specs = self.loadBatch(specs)
+            return self.processBatch(specs)
+        return self.deliver()
+
+    def result(self):
+        """
+        Structured view of current delivery
+        :return: DeliveryResult
+        """
+        need_patch = set([projet for projet, filename, need in self._list_patch if need])
+        projects = [ProjectResult(projet.path, projet.basename, projet.revision, projet.remote_url,
+                                  projet.commit_manifest.hexsha if projet.commit_manifest else None,
+                                  projet.commit_co.hexsha if projet.commit_co else None,
+                                  projet.commit_courant.hexsha if projet.commit_courant else None,
+                                  projet in need_patch) for projet in self._list_projects]
+        patches = [PatchResult(projet.path, filename, need) for projet, filename, need in self._list_patch]
+        archives = [ArchiveResult(path, archive) for path, archive in self._list_archives]
+        return DeliveryResult(self._args['output_folder'], projects, patches, archives,
+                              list(self._list_removed_projects), list(self._list_track_remote),
+                              list(self._list_remaining_git_folders), list(self._errors))
 
     def processDelivery(self):
         """
@@ -937,9 +2966,17 @@ Run \'./AospRepoTool.py -h\' for more information"""
         with open(join(self._args['output_folder'], "tracked_projects.json"), 'w') as fd:
             json.dump(self._list_track_remote, fd, indent=2)
 
+        # Save json file with patches too large because of binaries
+        if self._list_large_binaries:
+            with open(join(self._args['output_folder'], "large_binaries.json"), 'w') as fd:
+                json.dump(self._list_large_binaries, fd, indent=2)
+
         # Production des tar.gz des projets patché si besoin
         self.generateTars()
 
+        # Checksums of delivered files, checked by patching script on request
+        self.generateChecksums()
+
         # Une fois le remplacement branch/sha1 fait pour chaque projet, ont recréé le fichier de patch avec les modifs
         # appliquées
         # Création du script de patch si besoin
@@ -956,6 +2993,14 @@ Run \'./AospRepoTool.py -h\' for more information"""
             if self._list_oem_projects:
                 self.generateCleanupScript()
 
+        if self._args['pinned_manifest'] and not self._args['inspect_repo']:
+            self.generatePinnedManifest()
+
+        if self._args['verify_delivery'] and not self._args['inspect_repo']:
+            self.verifyDelivery()
+
+        self.closeReport()
+
     def generateCleanupScript(self):
         """
         Explicit method
@@ -980,6 +3025,60 @@ Run \'./AospRepoTool.py -h\' for more information"""
         mode = os.stat(file_name)
         os.chmod(file_name, stat.S_IMODE(mode.st_mode) | stat.S_IEXEC)
 
+    def generatePinnedManifest(self):
+        """
+        Writes the active manifest with each project revision pinned to its delivered commit, allowing a parallel
+        'repo sync' instead of the patching script. Projects whose delivered commit is not on a remote branch are
+        pinned to their checkout commit, their patch remaining to apply. Removed projects are dropped, remotes
+        and --track_remote projects revisions are kept
+        :return:
+        """
+        projects = {projet.path: projet for projet in self._list_projects}
+        remotes = OrderedDict()
+        default = None
+        pinned = []
+        pinned_paths = set()
+        local_only = []
+        for xml_manifest in self._xml_manifests:
+            content = xml_manifest.get('manifest') or {}
+            remote_list = content.get('remote', [])
+            for remote in remote_list if isinstance(remote_list, list) else [remote_list]:
+                remotes.setdefault(remote['@name'], remote)
+            if default is None and 'default' in content:
+                default = content['default']
+            project_list = content.get('project', [])
+            for projet_xml in project_list if isinstance(project_list, list) else [project_list]:
+                path = projet_xml.get('@path', projet_xml.get('@name'))
+                if path in self._list_removed_projects or path in pinned_paths:
+                    continue
+                projet_xml = OrderedDict(projet_xml)
+                projet = projects.get(path)
+                tracked = projet and [tr for tr in self._args['track_remote'] if tr in projet.remote_url]
+                if projet and projet.commit_courant and not tracked:
+                    commit = projet.commit_courant
+                    if not projet.isOnRemote(commit):
+                        local_only.append(path)
+                        commit = projet.commit_co
+                    if commit:
+                        if '@revision' in projet_xml and '@upstream' not in projet_xml:
+                            projet_xml['@upstream'] = projet_xml['@revision']
+                        projet_xml['@revision'] = commit.hexsha
+                pinned.append(projet_xml)
+                pinned_paths.add(path)
+
+        manifest = OrderedDict()
+        if remotes:
+            manifest['remote'] = list(remotes.values())
+        if default is not None:
+            manifest['default'] = default
+        manifest['project'] = pinned
+
+        file_name = join(self._args['output_folder'], '{}_pinned.xml'.format(self._args['product']))
+        with open(file_name, 'w') as f_out:
+            f_out.write(xmltodict.unparse({'manifest': manifest}, pretty=True, indent='  '))
+        self.logger.info("Pinned manifest written in {} ({} projects, {} with local only delivered commits: "
+                         "{})".format(file_name, len(pinned), len(local_only), local_only))
+
     def generateCleanupScript(self):
         """
         Explicit method
@@ -1006,6 +3105,97 @@ Run \'./AospRepoTool.py -h\' for more information"""
         except Exception as e:
             self.logger.error("Impossible to generate cleanup script: {}".format(e))
 
+    def generateChecksums(self):
+        """
+        Computes concurrently SHA-256 checksums of delivered patches and archives and writes them in SHA256SUMS of
+        output folder, in sha256sum format
+        :return: Dictionary of checksums by file path relative to output folder
+        """
+        file_names = []
+        for projet, filename, need_patch in self._list_patch:
+            if need_patch and filename:
+                if self._args['diff_format']:
+                    file_names.append(join(projet.path, filename))
+                else:
+                    file_names.append(filename)
+            if projet.binaries_archive:
+                file_names.append(projet.binaries_archive)
+            if self._args['tar']:
+                file_names.append(join('archive', projet.path.replace('/', '_') + ".tar.gz"))
+        file_names += [archive for path, archive in self._list_archives]
+        file_names = [f for f in OrderedDict.fromkeys(file_names) if isfile(join(self._args['output_folder'], f))]
+
+        progress = ProgressReporter(self.logger, "Checksums", len(file_names), 'files')
+
+        def checksum(file_name):
+            digest = hashlib.sha256()
+            with open(join(self._args['output_folder'], file_name), 'rb') as fd:
+                for block in iter(lambda: fd.read(CHECKSUM_BLOCK_SIZE), b''):
+                    digest.update(block)
+                    progress.update(0, len(block))
+            progress.update()
+            return digest.hexdigest()
+
+        with ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as executor:
+            self._checksums = OrderedDict(zip(file_names, executor.map(checksum, file_names)))
+        progress.finish()
+
+        with open(join(self._args['output_folder'], 'SHA256SUMS'), 'w') as fd:
+            for file_name, digest in self._checksums.items():
+                fd.write("{}  {}\n".format(digest, file_name))
+        return self._checksums
+
+    def writeScriptHeader(self, f_out):
+        """
+        Writes patching script header: arguments parsing and checksums verification of whole delivery on request
+        :param f_out: Generated script file
+        :return:
+        """
+        f_out.write("#!/bin/bash\n")
+        f_out.write("PATCH_HOME=$(pwd)\n")
+        f_out.write("AOSP_BASE=$1\n")
+
+        f_out.write("if [ $# -eq 0 ]; then\n")
+        f_out.write("echo \"{}_patch.sh aosp_root_dir [--remove_unused] [--verify | --verify_each]\"\n".format(
+            self._args['product']))
+        f_out.write("exit\n")
+        f_out.write("fi\n")
+
+        f_out.write("REMOVE_UNUSED=0\n"
+                    "VERIFY=0\n"
+                    "VERIFY_EACH=0\n"
+                    "for arg in \"${@:2}\"; do\n"
+                    "  case $arg in\n"
+                    "    --remove_unused) REMOVE_UNUSED=1 ;;\n"
+                    "    --verify) VERIFY=1 ;;\n"
+                    "    --verify_each) VERIFY_EACH=1 ;;\n"
+                    "  esac\n"
+                    "done\n")
+        if self._checksums:
+            f_out.write("if [ $VERIFY -eq 1 ]; then\n"
+                        "  (cd $PATCH_HOME && sha256sum -c --quiet SHA256SUMS)\n"
+                        "  if [ $? -ne 0 ]; then\n"
+                        "    echo \"Erreur: sommes de contrôle de la livraison invalides\"\n"
+                        "    exit 1\n"
+                        "  fi\n"
+                        "fi\n")
+
+    def writeChecksumInstructions(self, f_out, file_name):
+        """
+        Writes instructions checking a delivered file just before its use when script is run with --verify_each
+        :param f_out: Generated script file
+        :param file_name: File path relative to output folder
+        :return:
+        """
+        if file_name in self._checksums:
+            f_out.write("if [ $VERIFY_EACH -eq 1 ]; then\n"
+                        "  (cd $PATCH_HOME && echo \"{}  {}\" | sha256sum -c --quiet -)\n"
+                        "  if [ $? -ne 0 ]; then\n"
+                        "    echo \"Erreur: somme de contrôle invalide pour {}\"\n"
+                        "    exit 1\n"
+                        "  fi\n"
+                        "fi\n".format(self._checksums[file_name], file_name, file_name))
+
     def generateFullInstallPatch(self):
         """
         Explicit method
@@ -1014,14 +3204,7 @@ Run \'./AospRepoTool.py -h\' for more information"""
         try:
             file_name = join(self._args['output_folder'], '{}_patch.sh'.format(self._args['product']))
             with open(file_name, 'w') as f_out:
-                f_out.write("#!/bin/bash\n")
-                f_out.write("PATCH_HOME=$(pwd)\n")
-                f_out.write("AOSP_BASE=$1\n")
-
-                f_out.write("if [ $# -eq 0 ]; then\n")
-                f_out.write("echo \"{}_patch.sh aosp_root_dir [--remove_unused]\"\n".format(self._args['product']))
-                f_out.write("exit\n")
-                f_out.write("fi\n")
+                self.writeScriptHeader(f_out)
 
                 # basename, remote, remote_url, path, filename, commit, need_patch in self._list_patch:
                 for project, filename, need_patch in self._list_patch:
@@ -1029,8 +3212,8 @@ Run \'./AospRepoTool.py -h\' for more information"""
                     f_out.write("#Traitement de {} - {}\n".format(project.basename, path))
                     f_out.write("echo \"$AOSP_BASE/{}\"\n".format(path))
                     f_out.write("cd $AOSP_BASE/{}\n".format(path))
-                    if self._args['unshallow'] and need_patch:
-                        f_out.write("git fetch {} --unshallow -j{}\n".format(project.remote, self._args['jobs']))
+                    if self._args['unshallow'] and (need_patch or path in self._list_track_remote):
+                        self.writeDeepenInstructions(f_out, project)
                     if not self._args['no_rebase']:
                         f_out.write("git checkout {}\n".format(project.s_commit_co))
                         f_out.write("if [ $? -ne 0 ]; then\n"
@@ -1039,12 +3222,16 @@ Run \'./AospRepoTool.py -h\' for more information"""
                                     "fi\n".format(path))
                     f_out.write("git stash -u\n")
                     if need_patch:
-                        f_out.write("git am -3 -k --ignore-whitespace $PATCH_HOME/{}.patch\n".format(path.replace('/',
-                                                                                                                  '_')))
-                        f_out.write("if [ $? -ne 0 ]; then\n"
-                                    "  echo \"Erreur pour le repo {}: application du patch\"\n"
-                                    "  exit 1\n"
-                                    "fi\n".format(path))
+                        # Without patch when large binaries were the only changes
+                        if filename:
+                            self.writeChecksumInstructions(f_out, filename)
+                            f_out.write("{}\n".format(self.applyPatchCommand("$PATCH_HOME/{}".format(filename),
+                                                                              project)))
+                            f_out.write("if [ $? -ne 0 ]; then\n"
+                                        "  echo \"Erreur pour le repo {}: application du patch\"\n"
+                                        "  exit 1\n"
+                                        "fi\n".format(path))
+                        self.writeBinariesInstructions(f_out, project)
                     f_out.write("git tag -fa {} -m {}\n".format(self._args['product_tag'], self._args['product_tag']))
                     f_out.write("if [ $? -ne 0 ]; then\n"
                                 "  echo \"Erreur pour le repo {}: application du tag\"\n"
@@ -1055,6 +3242,7 @@ Run \'./AospRepoTool.py -h\' for more information"""
                     f_out.write("#Traitement des archives non suivies dans le manifest AOSP\n")
                     for path, archive in self._list_archives:
                         f_out.write("#Extraction de {} dans {}\n".format(archive, path))
+                        self.writeChecksumInstructions(f_out, archive)
                         f_out.write("rm -Rf $AOSP_BASE/{}\n".format(path))
                         f_out.write("tar -xf $PATCH_HOME/{} -C $AOSP_BASE\n".format(archive))
                         f_out.write("if [ $? -ne 0 ]; then\n"
@@ -1070,7 +3258,7 @@ Run \'./AospRepoTool.py -h\' for more information"""
 
                 if self._list_removed_projects:
                     f_out.write("#Traitement des projets non suivis du manifest AOSP\n")
-                    f_out.write("if [ \"$2\" = \"--remove_unused\" ]; then\n")
+                    f_out.write("if [ $REMOVE_UNUSED -eq 1 ]; then\n")
                     for path in self._list_removed_projects:
                         f_out.write("  cd $AOSP_BASE && rm -Rf {}\n".format(path))
                         f_out.write("  if [ $? -ne 0 ]; then\n"
@@ -1083,24 +3271,38 @@ Run \'./AospRepoTool.py -h\' for more information"""
         except Exception as e:
             self.logger.error("Impossible to generate patching script: {}".format(e))
 
+    def writeDeepenInstructions(self, f_out, project):
+        """
+        Writes instructions deepening a shallow clone just enough to contain the checkout commit, a full unshallow
+        being only done if incremental fetches failed
+        :param f_out: Generated script file
+        :param project: AospProject to handle
+        :return:
+        """
+        if project.commit_co is None:
+            return
+        check = "git cat-file -e {}^{{commit}} 2>/dev/null".format(project.commit_co.hexsha)
+        f_out.write("if [ \"$(git rev-parse --is-shallow-repository)\" = \"true\" ]; then\n")
+        f_out.write("  {} || git fetch {} --shallow-since={} -j{}\n".format(
+            check, project.remote, project.commit_co.committed_datetime.isoformat(), self._args['jobs']))
+        f_out.write("  {} || git fetch {} --deepen={} -j{}\n".format(check, project.remote, project.historyDepth(),
+                                                                     self._args['jobs']))
+        f_out.write("  {} || git fetch {} --unshallow -j{}\n".format(check, project.remote, self._args['jobs']))
+        f_out.write("fi\n")
+
     def generateDiffPatchInstall(self):
         file_name = join(self._args['output_folder'], '{}_patch.sh'.format(self._args['product']))
         with open(file_name, 'w') as f_out:
-            f_out.write("#!/bin/bash\n")
-            f_out.write("PATCH_HOME=$(pwd)\n")
-            f_out.write("AOSP_BASE=$1\n")
-
-            f_out.write("if [ $# -eq 0 ]; then\n")
-            f_out.write("echo \"{}_patch.sh aosp_root_dir [--remove_unused]\"\n".format(self._args['product']))
-            f_out.write("exit\n")
-            f_out.write("fi\n")
+            self.writeScriptHeader(f_out)
 
             for project, file, need_patch in self._list_patch:
                 f_out.write("echo \"$AOSP_BASE/{}\"\n".format(project.path))
                 f_out.write("cd $AOSP_BASE/{}\n".format(project.path))
                 f_out.write("git stash -u\n")
                 if need_patch:
-                    f_out.write("git am -3 -k --ignore-whitespace $PATCH_HOME/{}/{}\n".format(project.path, file))
+                    self.writeChecksumInstructions(f_out, join(project.path, file))
+                    f_out.write("{}\n".format(self.applyPatchCommand("$PATCH_HOME/{}/{}".format(project.path, file),
+                                                                      project)))
                     f_out.write("if [ $? -ne 0 ]; then\n"
                                 "  echo \"Erreur pour le repo {}: application du patch\"\n"
                                 "  exit 1\n"
@@ -1116,6 +3318,7 @@ Run \'./AospRepoTool.py -h\' for more information"""
                 f_out.write("#Traitement des archives non suivies dans le manifest AOSP\n")
                 for path, archive in self._list_archives:
                     f_out.write("#Extraction de {} dans {}\n".format(archive, path))
+                    self.writeChecksumInstructions(f_out, archive)
                     f_out.write("rm -Rf $AOSP_BASE/{}\n".format(path))
                     f_out.write("tar -xf $PATCH_HOME/{} -C $AOSP_BASE\n".format(archive))
                     f_out.write("if [ $? -ne 0 ]; then\n"
@@ -1132,7 +3335,153 @@ Run \'./AospRepoTool.py -h\' for more information"""
         mode = os.stat(file_name)
         os.chmod(file_name, stat.S_IMODE(mode.st_mode) | stat.S_IEXEC)
 
+    def verifyDelivery(self):
+        """
+        Applies concurrently the patches of each patched project in scratch worktrees, and writes pass/fail status
+        and timings in verification.json of output folder
+        :return: List of verification results (see AospProject.verifyPatches)
+        """
+        patches = OrderedDict()
+        for projet, filename, need_patch in self._list_patch:
+            if need_patch:
+                # Large binaries may be the only delivered changes of a project
+                patches.setdefault(projet, [])
+                if filename and self._args['diff_format']:
+                    patches[projet].append(join(self._args['output_folder'], projet.path, filename))
+                elif filename:
+                    patches[projet].append(join(self._args['output_folder'], filename))
+
+        start = time.time()
+        self.logger.info("Verifying patches of {} projects".format(len(patches)))
+        progress = ProgressReporter(self.logger, "Verifying patches", len(patches))
+
+        def verify(item):
+            result = item[0].verifyPatches(item[1], self)
+            progress.update(1, sum([getsize(file_path) for file_path in item[1] if exists(file_path)]))
+            return result
+
+        with ThreadPoolExecutor(max_workers=int(self._args['jobs'])) as executor:
+            results = list(executor.map(verify, patches.items()))
+        progress.finish()
+
+        for result in results:
+            if result['status'] != 'pass':
+                self.logger.error("! Patches of {} do not apply ({}/{} applied): {}".format(
+                    result['path'], result['applied'], result['patches'], result['error']))
+            elif not result['tree_match']:
+                self.logger.warning("! Patches of {} apply but do not rebuild delivered tree".format(result['path']))
+            else:
+                self.logger.debug("= Patches of {} apply ({}s)".format(result['path'], result['duration']))
+            if self._report:
+                self._report.add(dict(result, kind='verification'))
+
+        summary = {'pass': len([r for r in results if r['status'] == 'pass']),
+                   'fail': len([r for r in results if r['status'] != 'pass']),
+                   'duration': round(time.time() - start, 3)}
+        with open(join(self._args['output_folder'], 'verification.json'), 'w') as fd:
+            json.dump({'projects': results, 'summary': summary}, fd, indent=2)
+        self.logger.info("Verification done: {} pass, {} fail in {}s".format(summary['pass'], summary['fail'],
+                                                                          summary['duration']))
+        return results
+
+    def reportArchive(self, path, arch_name, duration):
+        """
+        Records a produced archive in delivery report if any
+        :param path: Archived project path
+        :param arch_name: Archive path relative to output folder
+        :param duration: Archiving time in seconds
+        :return:
+        """
+        if self._report:
+            self._report.add({'kind': 'archive', 'path': path, 'archive': arch_name,
+                              'archive_bytes': getsize(join(self._args['output_folder'], arch_name)),
+                              'duration': round(duration, 3)})
+
+    def archiveFingerprint(self, path):
+        """
+        Content fingerprint of a working tree: HEAD tree id and status (including untracked and ignored files),
+        changed files being described by their size and modification time
+        :param path: Project path in AOSP tree
+        :return: Hexadecimal digest
+        """
+        repo_path = join(self._args['aosp'], path)
+        digest = hashlib.sha256(path.encode())
+        try:
+            digest.update(subprocess.check_output(["git", "rev-parse", "--verify", "-q", "HEAD^{tree}"], cwd=repo_path))
+        except subprocess.CalledProcessError:
+            # No commit yet
+            pass
+        status = subprocess.check_output(["git", "status", "--porcelain", "-z", "--untracked-files=all", "--ignored"],
+                                         cwd=repo_path)
+        digest.update(status)
+        for entry in status.split(b'\0'):
+            try:
+                st = os.lstat(join(repo_path.encode(), entry[3:]))
+                digest.update("{} {}".format(st.st_size, st.st_mtime_ns).encode())
+            except (OSError, ValueError):
+                # Rename sources and empty entries
+                pass
+        return digest.hexdigest()
+
+    def buildArchive(self, path, file_name, progress=None):
+        """
+        Creates a tar.gz of a working tree, git metadata excluded
+        :param path: Project path in AOSP tree
+        :param file_name: Archive file
+        :param progress: Optional ProgressReporter updated with archived bytes
+        :return:
+        """
+        with tarfile.open(file_name, mode='w:gz') as tar:
+            def archive_filter(tarinfo):
+                if '.git' in tarinfo.name:
+                    return None
+                else:
+                    tarinfo.name = tarinfo.name.replace(self._args['aosp'][1:] + '/', '')
+                    if progress:
+                        progress.update(0, tarinfo.size)
+                return tarinfo
+            tar.add(join(self._args['aosp'], path), filter=archive_filter)
+
+    def produceArchive(self, path, arch_name, progress=None):
+        """
+        Stores the archive of a working tree in output folder. With an archive cache, archives are keyed by content
+        fingerprint and unchanged trees are hard linked (or copied) from the cache instead of archived again
+        :param path: Project path in AOSP tree
+        :param arch_name: Archive path relative to output folder
+        :param progress: Optional ProgressReporter updated with archived bytes
+        :return:
+        """
+        arch_file = join(self._args['output_folder'], arch_name)
+        start = time.time()
+        if not self._args['archive_cache']:
+            if exists(arch_file):
+                return
+            self.buildArchive(path, arch_file, progress)
+        else:
+            cached = join(self._args['archive_cache'], self.archiveFingerprint(path) + '.tar.gz')
+            if exists(cached):
+                if exists(arch_file) and os.path.samefile(cached, arch_file):
+                    return
+                self.logger.info("= Reusing cached archive of {}".format(path))
+            else:
+                temp_file = "{}.{}.{}.tmp".format(cached, os.getpid(), threading.get_ident())
+                self.buildArchive(path, temp_file, progress)
+                os.replace(temp_file, cached)
+            if exists(arch_file):
+                os.unlink(arch_file)
+            try:
+                os.link(cached, arch_file)
+            except OSError:
+                shutil.copy2(cached, arch_file)
+        self.reportArchive(path, arch_name, time.time() - start)
+
     def generateTars(self):
+        total = len(self._list_remaining_git_folders)
+        if self._args['tar']:
+            total += len(self._list_patch)
+        progress = ProgressReporter(self.logger, "Archiving", total, 'archives')
+        built, self._pipeline_archives = self._pipeline_archives, set()
+
         if not self._args['inspect_repo'] and self._args['tar'] and self._list_patch:
             # Creation of zip file for this project
             # for basename, remote, remote_url, path, s_commit_co, need_patch in self._list_patch:
@@ -1141,40 +3490,170 @@ Run \'./AospRepoTool.py -h\' for more information"""
                 self.logger.warning("Production d'un tar.gz pour {}".format(arch_name))
                 if not exists(join(self._args['output_folder'], 'archive')):
                     makedirs(join(self._args['output_folder'], 'archive'))
-                if not exists(join(self._args['output_folder'], 'archive', arch_name)):
-                    with tarfile.open(join(self._args['output_folder'], 'archive', arch_name), mode='w:gz') as tar:
-                        def archive_filter(tarinfo):
-                            if '.git' in tarinfo.name:
-                                return None
-                            else:
-                                tarinfo.name = tarinfo.name.replace(self._args['aosp'][1:] + '/', '')
-                                self.logger.debug("T+: Adding {} to archive {}".format(tarinfo.name, arch_name))
-                            return tarinfo
-                        tar.add(join(self._args['aosp'], project.path), filter=archive_filter)
+                if join('archive', arch_name) not in built:
+                    self.produceArchive(project.path, join('archive', arch_name), progress)
+                progress.update()
 
         # Records git project not tracked by manifest system
         if self._list_remaining_git_folders:
             self.logger.warning(
-                "Few projects have not been handles by manifests:\n {}".format(self._list_remaining_git_folders))
+                "Few projects have not been handles by manifests:\n {}".format(list(self._list_remaining_git_folders)))
             with open(join(self._args['output_folder'], 'left_repos.json'), 'w') as f_out:
-                json.dump(self._list_remaining_git_folders, f_out, indent=4)
+                json.dump(list(self._list_remaining_git_folders), f_out, indent=4)
 
             if not self._args['inspect_repo']:
                 # Creation of tar.gz file pour those projects
                 for path in self._list_remaining_git_folders:
                     arch_name = path.replace('/', '_') + ".tar.gz"
-                    if not exists(arch_name):
-                        with tarfile.open(join(self._args['output_folder'], arch_name), mode='w:gz') as tar:
-                            def archive_filter(tarinfo):
-                                if '.git' in tarinfo.name:
-                                    return None
-                                else:
-                                    tarinfo.name = tarinfo.name.replace(self._args['aosp'][1:] + '/', '')
-                                # self.logger.debug("T+: Adding {} to archive {}".format(tarinfo.name, arch_name))
-                                return tarinfo
-
-                            tar.add(join(self._args['aosp'], path), filter=archive_filter)
+                    if arch_name not in built:
+                        self.produceArchive(path, arch_name, progress)
                     self._list_archives.append((path, arch_name))
+                    progress.update()
+
+        if total and not self._args['inspect_repo']:
+            progress.finish()
+
+
+class AospRepoWatcher:
+    """
+    Long running mode keeping manifests and repositories of an AospRepoTool warm: HEAD and refs of projects are
+    polled and only changed projects are processed again before delivery scripts regeneration. A local socket
+    accepts 'deliver' (fresh full delivery), 'status' and 'stop' commands
+    """
+    def __init__(self, tool, interval=2.0, socket_path=None):
+        self._tool = tool
+        self._interval = float(interval)
+        self._socket_path = socket_path
+        self._server = None
+        self._signatures = {}
+        self.logger = tool.logger
+
+    def snapshot(self):
+        """
+        Records refs signature of every project
+        :return: List of projects whose signature changed since previous snapshot
+        """
+        changed = []
+        for projet in self._tool.projects:
+            signature = projet.refsSignature()
+            if self._signatures.get(projet) != signature:
+                self._signatures[projet] = signature
+                changed.append(projet)
+        return changed
+
+    def deliver(self):
+        """
+        Fresh full delivery of every project
+        :return:
+        """
+        self.logger.info("Full delivery requested")
+        failed = self._tool.updateProjects(self._tool.projects)
+        self.snapshot()
+        self.retry(failed)
+        if failed:
+            raise AospRepoToolError("Delivery failed for {}".format(", ".join([projet.path for projet in failed])), 1)
+
+    def retry(self, projects):
+        """
+        Forgets signatures of projects which failed to process, for next poll to process them again
+        :param projects: List of AospProject
+        :return:
+        """
+        for projet in projects:
+            self._signatures.pop(projet, None)
+
+    def openSocket(self):
+        if self._socket_path:
+            if exists(self._socket_path):
+                os.unlink(self._socket_path)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(self._socket_path)
+            self._server.listen(4)
+            self.logger.info("Listening for delivery requests on {}".format(self._socket_path))
+
+    def closeSocket(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+            if exists(self._socket_path):
+                os.unlink(self._socket_path)
+
+    def handleRequest(self):
+        """
+        Serves one socket request
+        :return: False when watcher should stop
+        """
+        conn, _ = self._server.accept()
+        with conn:
+            command = conn.recv(1024).decode().strip()
+            self.logger.info("Request received: {}".format(command))
+            if command == 'deliver':
+                try:
+                    self.deliver()
+                    conn.sendall("done {}\n".format(self._tool.args['output_folder']).encode())
+                except Exception as e:
+                    self.logger.error("Delivery failed: {}".format(e))
+                    conn.sendall("error {}\n".format(e).encode())
+            elif command == 'status':
+                conn.sendall("watching {} projects\n".format(len(self._tool.projects)).encode())
+            elif command == 'stop':
+                conn.sendall(b"stopping\n")
+                return False
+            else:
+                conn.sendall("unknown command {}\n".format(command).encode())
+        return True
+
+    def run(self):
+        """
+        Initial delivery then watch loop, until a 'stop' request or an interruption
+        :return:
+        """
+        self.snapshot()
+        self._tool.processProjects()
+        self._tool.processDelivery()
+        self.openSocket()
+        try:
+            running = True
+            while running:
+                if self._server:
+                    readable, _, _ = select.select([self._server], [], [], self._interval)
+                    if readable:
+                        running = self.handleRequest()
+                        continue
+                else:
+                    time.sleep(self._interval)
+
+                changed = self.snapshot()
+                if changed:
+                    self.logger.info("Changes detected in {}".format(changed))
+                    try:
+                        self.retry(self._tool.updateProjects(changed))
+                    except Exception as e:
+                        self.logger.error("Incremental update failed: {}".format(e))
+        except KeyboardInterrupt:
+            self.logger.info("Watch interrupted")
+        finally:
+            self.closeSocket()
+
+
+def sendWatchCommand(socket_path, command):
+    """
+    Sends a command to a running watcher
+    :param socket_path: Watcher socket path
+    :param command: 'deliver', 'status' or 'stop'
+    :return: Watcher answer
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(command.encode())
+        client.shutdown(socket.SHUT_WR)
+        answer = b""
+        while True:
+            data = client.recv(1024)
+            if not data:
+                break
+            answer += data
+    return answer.decode()
 
 
 if __name__ == '__main__':
@@ -1197,17 +3676,24 @@ if __name__ == '__main__':
 
     tool.setLogger(logger)
 
-    # Argument normalisation
-    tool.processArgs()
-
-    # Manifests parsing
-    tool.parseManifests()
-
-    # Projects processing
-    tool.processManifests()
+    # Request to a running watcher
+    if args['watch_command']:
+        if not args['watch_socket']:
+            logger.error("A watcher socket is required (--watch_socket)")
+            exit(1)
+        print(sendWatchCommand(args['watch_socket'], args['watch_command']), end='')
+        exit(0)
 
-    # Projects processing
-    tool.processProjects()
+    try:
+        if args['watch']:
+            # Arguments normalisation, manifests parsing and checks of the whole tree, analysis being done once
+            tool.analyse()
 
-    # Patch Script generation
-    tool.processDelivery()
+            # Warm process updating delivery on changes
+            AospRepoWatcher(tool, args['watch_interval'], args['watch_socket']).run()
+        else:
+            # Streaming delivery, fast inspection, batch of deliveries or single delivery according to options
+            tool.run()
+    except AospRepoToolError as e:
+        logger.error("=> Exit: {}".format(e))
+        exit(e.code)
@@ -0,0 +1,392 @@
+"""
+Tests of AospRepoTool on throwaway git repositories, a local bare repository standing in for the remote
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from os.path import abspath, dirname, join
+
+import git
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from AospRepoTool import AospProject, AospRepoTool, AospRepoToolError, GitMetadata, RefCache  # noqa: E402
+
+LOGGER = logging.getLogger("test_aosp_repo_tool")
+
+GIT_ENV = {'GIT_AUTHOR_NAME': 'test', 'GIT_AUTHOR_EMAIL': 'test@localhost',
+           'GIT_COMMITTER_NAME': 'test', 'GIT_COMMITTER_EMAIL': 'test@localhost'}
+
+
+def run(cwd, *args, **variables):
+    """
+    Runs a git command in a test repository
+    :param variables: Additional environment variables
+    :return: Stripped standard output
+    """
+    env = dict(os.environ)
+    env.update(GIT_ENV)
+    env.update(variables)
+    return subprocess.run(["git"] + list(args), cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          check=True, universal_newlines=True).stdout.strip()
+
+
+def dated(date):
+    """
+    :return: Environment variables setting author and committer dates, in seconds since epoch
+    """
+    if date is None:
+        return {}
+    return {'GIT_AUTHOR_DATE': '@{} +0000'.format(date), 'GIT_COMMITTER_DATE': '@{} +0000'.format(date)}
+
+
+def commit(cwd, message, date=None):
+    """
+    Commits a change of a file named after the message
+    :return: Commit id
+    """
+    with open(join(cwd, 'file.txt'), 'w') as fd:
+        fd.write(message + '\n')
+    run(cwd, 'add', '-A')
+    run(cwd, 'commit', '-q', '-m', message, **dated(date))
+    return run(cwd, 'rev-parse', 'HEAD')
+
+
+class GitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='aosp_repo_tool_')
+        self.aosp = join(self.root, 'aosp')
+        os.makedirs(self.aosp)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def options(self, **kwargs):
+        return AospRepoTool(aosp=self.aosp, **kwargs).args
+
+    def project(self, path, revision='main', **kwargs):
+        return AospProject('default', path, GitMetadata(join(self.aosp, path)), 'origin', revision,
+                           self.options(**kwargs), LOGGER)
+
+    def remote(self, commits):
+        """
+        Builds a bare remote repository with a linear history
+        :return: Path of remote and list of commit ids, oldest first
+        """
+        work = join(self.root, 'work')
+        run(self.root, 'init', '-q', '-b', 'main', work)
+        ids = [commit(work, 'commit {}'.format(idx)) for idx in range(commits)]
+        remote = join(self.root, 'remote.git')
+        run(self.root, 'clone', '-q', '--bare', work, remote)
+        return remote, ids
+
+
+class TestGitMetadataParsers(unittest.TestCase):
+    def test_packed_refs_fully_peeled(self):
+        refs = GitMetadata.parsePackedRefs(['# pack-refs with: peeled fully-peeled sorted ',
+                                            'a' * 40 + ' refs/heads/main',
+                                            'b' * 40 + ' refs/tags/v1',
+                                            '^' + 'c' * 40])
+        self.assertEqual(refs['refs/heads/main'], ('a' * 40, 'a' * 40))
+        self.assertEqual(refs['refs/tags/v1'], ('b' * 40, 'c' * 40))
+
+    def test_packed_refs_not_peeled(self):
+        refs = GitMetadata.parsePackedRefs(['a' * 40 + ' refs/tags/v1'])
+        self.assertEqual(refs['refs/tags/v1'], ('a' * 40, None))
+        self.assertEqual(GitMetadata.parsePackedRefs([]), {})
+
+    def test_config(self):
+        config = GitMetadata.parseConfig(['[core]', '\tbare = true', '; comment', '[remote "origin"]',
+                                          '\turl = /tmp/a.git', '\turl = "/tmp/b.git"', '[Extensions]',
+                                          '\tworktreeConfig'])
+        self.assertEqual(config[('core', '')], {'bare': ['true']})
+        self.assertEqual(config[('remote', 'origin')]['url'], ['/tmp/a.git', '/tmp/b.git'])
+        self.assertEqual(config[('extensions', '')], {'worktreeconfig': ['true']})
+
+
+class TestSelection(unittest.TestCase):
+    def matches(self, patterns, path):
+        return AospRepoTool.matchesSelection(AospRepoTool.compileSelection(patterns), path)
+
+    def groups(self, requested, path, **attributes):
+        tool = AospRepoTool(aosp=dirname(abspath(__file__)))
+        tool._groups = requested.split(',')
+        return tool.matchesGroups(dict(('@' + key, value) for key, value in attributes.items()), path)
+
+    def test_exact(self):
+        self.assertEqual(AospRepoTool.compileSelection(['device/foo/', 'bar']), ({'device/foo', 'bar'}, None))
+        self.assertTrue(self.matches(['device/foo/'], 'device/foo'))
+        self.assertFalse(self.matches(['device/foo'], 'device/foobar'))
+        self.assertFalse(self.matches([], 'device/foo'))
+
+    def test_glob(self):
+        self.assertTrue(self.matches(['device/*'], 'device/foo'))
+        self.assertTrue(self.matches(['device/*/'], 'device/foo/bar'))
+        self.assertTrue(self.matches(['vendor/?'], 'vendor/a'))
+        self.assertFalse(self.matches(['vendor/?'], 'vendor/ab'))
+        self.assertTrue(self.matches(['bar', 'vendor/[ab]*'], 'vendor/b1'))
+
+    def test_regular_expression(self):
+        self.assertTrue(self.matches(['re:device/(foo|bar)'], 'device/bar'))
+        # Expressions match whole paths
+        self.assertFalse(self.matches(['re:device/foo'], 'device/foobar'))
+        self.assertFalse(self.matches(['re:foo'], 'device/foo'))
+        self.assertTrue(self.matches(['re:device/.*', 'vendor/*'], 'vendor/a'))
+
+    def test_invalid_regular_expression(self):
+        with self.assertRaises(AospRepoToolError):
+            AospRepoTool.compileSelection(['re:device/(foo'])
+
+    def test_default_groups(self):
+        self.assertTrue(self.groups('default', 'device/foo'))
+        self.assertTrue(self.groups('default', 'device/foo', groups='pdk,tools'))
+        self.assertFalse(self.groups('default', 'device/foo', groups='pdk,notdefault'))
+        self.assertTrue(self.groups('all', 'device/foo', groups='notdefault'))
+        self.assertFalse(self.groups('pdk', 'device/foo'))
+        self.assertTrue(self.groups('pdk', 'device/foo', groups='pdk tools'))
+
+    def test_name_and_path_groups(self):
+        self.assertTrue(self.groups('name:platform/foo', 'device/foo', name='platform/foo'))
+        self.assertTrue(self.groups('path:device/foo', 'device/foo', name='platform/foo'))
+        self.assertFalse(self.groups('name:device/foo', 'device/foo', name='platform/foo'))
+        # Projects without name are named after their path
+        self.assertTrue(self.groups('name:device/foo', 'device/foo'))
+
+    def test_exclusion_order(self):
+        self.assertFalse(self.groups('default,-pdk', 'device/foo', groups='pdk'))
+        self.assertTrue(self.groups('-pdk,default', 'device/foo', groups='pdk'))
+        self.assertTrue(self.groups('default,-pdk', 'device/bar', groups='tools'))
+        self.assertFalse(self.groups('all,-path:device/foo', 'device/foo'))
+        self.assertFalse(self.groups('-default', 'device/foo'))
+
+
+class TestGitMetadata(GitTestCase):
+    def setUp(self):
+        super().setUp()
+        remote, self.ids = self.remote(3)
+        self.path = join(self.aosp, 'proj')
+        run(self.root, 'clone', '-q', remote, self.path)
+        run(self.path, 'tag', '-a', 'loose', '-m', 'loose', self.ids[0])
+        run(self.path, 'tag', 'light', self.ids[1])
+        run(self.path, 'branch', 'loose', self.ids[2])
+
+    def test_missing_and_invalid(self):
+        with self.assertRaises(git.exc.NoSuchPathError):
+            GitMetadata(join(self.root, 'none'))
+        with self.assertRaises(git.exc.InvalidGitRepositoryError):
+            GitMetadata(self.root)
+
+    def test_remotes_and_bare(self):
+        metadata = GitMetadata(self.path)
+        self.assertEqual(list(metadata.remotes().keys()), ['origin'])
+        self.assertFalse(metadata.bare)
+        self.assertFalse(metadata.isShallow())
+        self.assertTrue(GitMetadata(join(self.root, 'remote.git')).bare)
+
+    def test_symbolic_head(self):
+        self.assertEqual(GitMetadata(self.path).readRef('HEAD'), ('refs/heads/main', self.ids[2], self.ids[2]))
+
+    def test_short_names(self):
+        metadata = GitMetadata(self.path)
+        # Tags come before branches of the same name
+        self.assertEqual(metadata.resolveRef('loose')[0], 'refs/tags/loose')
+        self.assertEqual(metadata.resolveRef('heads/loose')[0], 'refs/heads/loose')
+        self.assertEqual(metadata.resolveRef('origin/main')[0], 'refs/remotes/origin/main')
+        self.assertEqual(metadata.resolveRef('origin')[0], 'refs/remotes/origin/main')
+        self.assertIsNone(metadata.resolveRef('none'))
+
+    def test_tags_peeling(self):
+        metadata = GitMetadata(self.path)
+        # Loose annotated tags are left to git, lightweight tags point to commits
+        name, object_id, peeled = metadata.resolveRef('loose')
+        self.assertNotEqual(object_id, self.ids[0])
+        self.assertIsNone(peeled)
+        self.assertEqual(metadata.resolveRef('light')[1:], (self.ids[1], None))
+
+        run(self.path, 'pack-refs', '--all')
+        metadata = GitMetadata(self.path)
+        self.assertEqual(metadata.resolveRef('loose')[1:], (object_id, self.ids[0]))
+        self.assertEqual(metadata.resolveRef('light')[1:], (self.ids[1], self.ids[1]))
+        self.assertEqual(self.project('proj').resolveCommit('loose').hexsha, self.ids[0])
+
+    def test_packed_refs_refresh(self):
+        metadata = GitMetadata(self.path)
+        run(self.path, 'pack-refs', '--all')
+        self.assertEqual(metadata.resolveRef('light')[2], self.ids[1])
+        run(self.path, 'tag', '-d', 'light')
+        self.assertIsNone(metadata.resolveRef('light'))
+
+    def test_worktree_gitlink(self):
+        worktree = join(self.root, 'worktree')
+        run(self.path, 'worktree', 'add', '-q', '-b', 'feature', worktree, self.ids[1])
+        metadata = GitMetadata(worktree)
+        self.assertEqual(metadata.common_dir, join(self.path, '.git'))
+        self.assertNotEqual(metadata.git_dir, metadata.common_dir)
+        self.assertEqual(metadata.readRef('HEAD'), ('refs/heads/feature', self.ids[1], self.ids[1]))
+        self.assertEqual(metadata.resolveRef('main')[1], self.ids[2])
+        self.assertEqual(list(metadata.remotes().keys()), ['origin'])
+
+
+class TestDeepen(GitTestCase):
+    def setUp(self):
+        super().setUp()
+        remote, self.ids = self.remote(40)
+        self.path = join(self.aosp, 'proj')
+        run(self.root, 'clone', '-q', '--depth', '1', 'file://' + remote, self.path)
+
+    def contains(self, sha):
+        return lambda: sha in run(self.path, 'rev-list', 'HEAD').split()
+
+    def test_reached_without_fetch(self):
+        project = self.project('proj', deepen_step=2)
+        self.assertTrue(project.deepen(lambda: True))
+        self.assertEqual(run(self.path, 'rev-list', '--count', 'HEAD'), '1')
+
+    def test_incremental(self):
+        project = self.project('proj', deepen_step=2)
+        self.assertTrue(project.isShallow())
+        self.assertTrue(project.deepen(self.contains(self.ids[-5])))
+        # Steps of 2 then 4 commits are enough, history stays shallow
+        self.assertTrue(project.isShallow())
+        self.assertEqual(run(self.path, 'rev-list', '--count', 'HEAD'), '7')
+
+    def test_full_unshallow_fallback(self):
+        project = self.project('proj', deepen_step=1)
+        self.assertFalse(project.deepen(lambda: False))
+        self.assertFalse(project.isShallow())
+        self.assertEqual(run(self.path, 'rev-list', '--count', 'HEAD'), '40')
+
+
+class TestSearchDivergence(GitTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = join(self.aosp, 'proj')
+        run(self.root, 'init', '-q', '-b', 'main', self.path)
+        self.base = [commit(self.path, 'base {}'.format(idx)) for idx in range(3)]
+        run(self.path, 'checkout', '-q', '-b', 'local')
+        self.local = [commit(self.path, 'local {}'.format(idx)) for idx in range(3)]
+        run(self.path, 'checkout', '-q', 'main')
+        self.upstream = [commit(self.path, 'upstream {}'.format(idx)) for idx in range(3)]
+        run(self.path, 'checkout', '-q', '--orphan', 'other')
+        self.other = commit(self.path, 'other')
+
+    def search(self, manifest, courant, **kwargs):
+        project = self.project('proj', **kwargs)
+        project._commit_manifest = project.resolveCommit(manifest)
+        project._commit_courant = project.resolveCommit(courant)
+        return project.searchDivergence()
+
+    def test_behind(self):
+        self.assertEqual(self.search(self.upstream[-1], self.base[0]), ('behind', self.base[0]))
+        self.assertEqual(self.search(self.base[1], self.base[1]), ('behind', self.base[1]))
+
+    def test_ahead(self):
+        self.assertEqual(self.search(self.base[0], self.local[-1]), ('ahead', self.base[0]))
+
+    def test_diverged(self):
+        self.assertEqual(self.search(self.upstream[-1], self.local[-1]), ('diverged', self.base[-1]))
+
+    def test_unrelated(self):
+        self.assertEqual(self.search(self.upstream[-1], self.other), ('unrelated', self.base[0]))
+
+    def test_limits_only_bound_divergence(self):
+        self.assertEqual(self.search(self.base[0], self.local[-1], max_depth=1), ('ahead', self.base[0]))
+        self.assertEqual(self.search(self.upstream[-1], self.base[0], max_depth=1), ('behind', self.base[0]))
+        self.assertEqual(self.search(self.upstream[-1], self.local[-1], max_depth=1),
+                         ('too_deep', self.upstream[-1]))
+
+
+class TestRefCache(GitTestCase):
+    def setUp(self):
+        super().setUp()
+        remote, self.ids = self.remote(3)
+        self.paths = [join(self.aosp, 'proj'), join(self.aosp, 'copy')]
+        run(self.root, 'clone', '-q', remote, self.paths[0])
+        run(self.paths[0], 'tag', '-a', 'rel', '-m', 'rel', self.ids[1])
+
+        # Second checkout of the same project, sharing objects as repo tool does with .repo/project-objects
+        shutil.copytree(join(self.paths[0], '.git'), join(self.paths[1], '.git'),
+                        ignore=shutil.ignore_patterns('objects'))
+        os.symlink(join(self.paths[0], '.git', 'objects'), join(self.paths[1], '.git', 'objects'))
+        run(self.paths[1], 'checkout', '-q', '-f', 'main')
+        self.cache = RefCache(None, LOGGER)
+
+    def project(self, path, revision='main', **kwargs):
+        return AospProject('default', path, GitMetadata(join(self.aosp, path)), 'origin', revision,
+                           self.options(**kwargs), LOGGER, self.cache)
+
+    def test_shared_object_store(self):
+        projects = [self.project('proj'), self.project('copy')]
+        self.assertEqual(projects[0].objectsDir(), projects[1].objectsDir())
+        tag_id = run(self.paths[0], 'rev-parse', 'refs/tags/rel')
+        self.assertIsNone(self.cache.get(projects[1].objectsDir(), tag_id))
+
+        self.assertEqual(projects[0].resolveTag('rel').hexsha, self.ids[1])
+        self.assertEqual(self.cache.get(projects[1].objectsDir(), tag_id), self.ids[1])
+        self.assertEqual(projects[1].resolveTag('rel').hexsha, self.ids[1])
+
+    def test_fetch_once_per_git_folder(self):
+        fetches = []
+        self.assertTrue(self.cache.fetchOnce(self.paths[0], lambda: fetches.append(0)))
+        self.assertFalse(self.cache.fetchOnce(self.paths[0], lambda: fetches.append(0)))
+        self.assertTrue(self.cache.fetchOnce(self.paths[1], lambda: fetches.append(1)))
+        self.cache.forgetFetch(self.paths[0])
+        self.assertTrue(self.cache.fetchOnce(self.paths[0], lambda: fetches.append(0)))
+        self.assertEqual(fetches, [0, 1, 0])
+
+
+class TestPatchSeries(GitTestCase):
+    def setUp(self):
+        super().setUp()
+        # Side branches merged without fast forward leave ranges made of a merge commit only
+        self.path = join(self.aosp, 'proj')
+        run(self.root, 'init', '-q', '-b', 'main', self.path)
+        self.base = commit(self.path, 'c0', 1000000000)
+        commit(self.path, 'c1', 1000000001)
+        run(self.path, 'checkout', '-q', '-b', 'side')
+        commit(self.path, 's1', 1000000002)
+        commit(self.path, 's2', 1000000003)
+        run(self.path, 'checkout', '-q', 'main')
+        run(self.path, 'merge', '-q', '--no-ff', '-m', 'm1', 'side', **dated(1000000004))
+        commit(self.path, 'c2', 1000000005)
+        run(self.path, 'checkout', '-q', '-b', 'side2')
+        commit(self.path, 's3', 1000000006)
+        run(self.path, 'checkout', '-q', 'main')
+        run(self.path, 'merge', '-q', '--no-ff', '-m', 'm2', 'side2', **dated(1000000007))
+        self.head = commit(self.path, 'c3', 1000000008)
+
+        # Patches are signed off by the identity of the test environment
+        environment = mock.patch.dict(os.environ, GIT_ENV)
+        environment.start()
+        self.addCleanup(environment.stop)
+
+    def series(self, jobs):
+        output_folder = join(self.root, 'jobs_{}'.format(jobs))
+        patches = self.project('proj', jobs=jobs).savePatchSeries(self.base, self.head, output_folder)
+        contents = {}
+        for file_name in sorted(os.listdir(output_folder)):
+            with open(join(output_folder, file_name)) as fd:
+                contents[file_name] = fd.read()
+        self.assertEqual([file_name for _, _, file_name in patches], list(contents.keys()))
+        return contents
+
+    def test_merge_only_ranges(self):
+        # 8 ranges, chunks of 2 ranges with a single worker and of a single range with 4 workers
+        for jobs in (1, 4):
+            contents = self.series(jobs)
+            self.assertEqual(list(contents.keys()), ['00_proj.patch', '01_proj.patch', '02_proj.patch',
+                                                     '04_proj.patch', '05_proj.patch', '07_proj.patch'])
+            for (file_name, content), subject in zip(contents.items(), ['c1', 's1', 's2', 'c2', 's3', 'c3']):
+                self.assertEqual(content.count('\nSubject: '), 1, file_name)
+                self.assertIn('\nSubject: {}\n'.format(subject), content)
+        self.assertEqual(self.series(1), self.series(4))
+
+
+if __name__ == '__main__':
+    unittest.main()